@@ -5,7 +5,14 @@ try:
 	from Crypto.Cipher import AES as PyAES
 	class AES:
 		def __init__(self, key_encrypt):
-			self.aes = PyAES.new(key_encrypt, PyAES.MODE_ECB)
+			self.key = bytes(key_encrypt)
+			self.aes = PyAES.new(self.key, PyAES.MODE_ECB)
+			self.cbc = PyAES.new(self.key, PyAES.MODE_CBC, iv=bytes(16))
+			self.cbc_iv = bytes(16)
+
+		# A context for another thread, since the CBC chain is shared
+		def copy(self):
+			return AES(self.key)
 
 		def encrypt(self, plaintext):
 			return bytearray(self.aes.encrypt(bytes(plaintext)))
@@ -13,12 +20,46 @@ try:
 		def decrypt(self, ciphertext):
 			return bytearray(self.aes.decrypt(bytes(ciphertext)))
 
+		# ECB encrypt any number of blocks in one call
+		def encrypt_blocks(self, plaintext):
+			return self.aes.encrypt(bytes(plaintext))
+
+		# Native modes used by CCM to avoid a Python call per block.
+		# Counter mode XOR of data, starting at the 16-byte counter
+		# block, which has a 16-bit counter in the last two bytes.
+		# The counter blocks are run through the existing ECB object,
+		# since creating a new CTR object costs more than the AES.
+		def ctr(self, counter, data):
+			n = len(data)
+			prefix = bytes(counter[0:14])
+			start = counter[14] << 8 | counter[15]
+			blocks = b''.join([
+				prefix + ((start + i) & 0xFFFF).to_bytes(2, "big")
+				for i in range((n + 15) // 16)
+			])
+			xor = self.aes.encrypt(blocks)
+			return (int.from_bytes(data, "big") ^ int.from_bytes(xor[0:n], "big")).to_bytes(n, "big")
+
+		# The last block of the CBC encryption of data with a zero IV.
+		# The CBC object is reused and chains from its last output,
+		# so that block is folded into the first block of the data to
+		# restart the chain. Like the Gecko wrapper this means that an
+		# AES object must not be shared between threads.
+		def cbc_mac(self, data):
+			data = bytearray(data)
+			data[0:16] = (int.from_bytes(data[0:16], "big") ^ int.from_bytes(self.cbc_iv, "big")).to_bytes(16, "big")
+			self.cbc_iv = self.cbc.encrypt(data)[-16:]
+			return self.cbc_iv
+
 except:
 	# Gecko AES wrapper in ECB mode.
 	# on the actual hardware, use the accelerated mode
 	# This uses a temporary buffer for the output and must be used
 	# before the next operation.
-	from machine import Crypto
+	try:
+		from machine import Crypto
+	except:
+		Crypto = None
 
 	class AES:
 		def __init__(self, key_encrypt):
@@ -26,6 +67,10 @@ except:
 			self.key_decrypt = Crypto.aes_decryptkey(key_encrypt)
 			self.out = bytearray(16)
 
+		# The output buffer is shared, so each thread needs its own
+		def copy(self):
+			return AES(self.key_encrypt)
+
 		def encrypt(self, plaintext):
 			Crypto.aes_ecb_encrypt(self.key_encrypt, plaintext, self.out)
 			return self.out
@@ -33,3 +78,17 @@ except:
 		def decrypt(self, ciphertext):
 			Crypto.aes_ecb_decrypt(self.key_decrypt, ciphertext, self.out)
 			return self.out
+
+		# ECB encrypt any number of blocks; the hardware only does
+		# one at a time, so this returns a new buffer
+		def encrypt_blocks(self, plaintext):
+			out = bytearray(len(plaintext))
+			for i in range(0, len(plaintext), 16):
+				Crypto.aes_ecb_encrypt(self.key_encrypt, plaintext[i:i+16], self.out)
+				out[i:i+16] = self.out
+			return out
+
+	# Neither pycryptodome nor the hardware is available, so
+	# use the portable (but slow) pure Python implementation
+	if Crypto is None:
+		from ZbPy.PureAES import AES
@@ -0,0 +1,266 @@
+# asyncio interface to a Zigbee device.
+#
+# The IEEEDevice and NetworkDevice run on an asyncio event loop: their
+# timers are scheduled with the loop, and the radio delivers frames from
+# a reader callback, so there is no tick() to poll and no thread.
+#
+#	radio = AsyncDevice.SerialRadio(link, mac)
+#	nwk = AsyncDevice.NetworkDevice(radio)
+#	await nwk.send(dst, payload)	# returns once the MAC ACK arrives
+#	async for msg in nwk:		# the NWK data frames that arrive
+#		print(msg.src, msg.aps)
+#
+# send() raises SendError if the frame is never acked. Any number of
+# coroutines can send at once; they wait for room in the device's
+# transmit queue, which keeps several frames outstanding (see TxQueue.py).
+#
+# This is only for the host; it does not run on MicroPython.
+import asyncio
+import random
+
+from ZbPy import Device
+from ZbPy import IEEE802154
+from ZbPy import ZigbeeApplication
+from ZbPy import Scheduler
+
+class SendError(Exception):
+	pass
+
+
+# The Scheduler interface, with the timers run by the event loop
+class LoopScheduler(Scheduler.Scheduler):
+	def __init__(self, loop):
+		self.loop = loop
+		self.handles = {}
+		self.count = 0
+		self.fired = 0
+
+	def __str__(self):
+		return "LoopScheduler(timers=%d, fired=%d)" % (self.count, self.fired)
+
+	def now(self):
+		return int(self.loop.time() * 1e6)
+
+	def start_at(self, timer, when):
+		if timer.active:
+			self.cancel(timer)
+		timer.when = when
+		timer.active = True
+		self.handles[timer] = self.loop.call_at(when * 1e-6, self.fire, timer)
+		self.count += 1
+
+	def cancel(self, timer):
+		if not timer.active:
+			return
+		timer.active = False
+		self.handles.pop(timer).cancel()
+		self.count -= 1
+
+	# the loop waits for the timers itself
+	def timeout(self):
+		return None
+
+	def run(self):
+		return 0
+
+	def fire(self, timer):
+		del self.handles[timer]
+		timer.active = False
+		self.count -= 1
+		if timer.period != 0:
+			now = self.now()
+			when = timer.when + timer.period
+			if when <= now:
+				when = now + timer.period
+			self.start_at(timer, when)
+		self.fired += 1
+		timer.func()
+
+
+# The addresses of a radio, and the device that it delivers frames to.
+# The frames are pushed to the device as they arrive, so rx() has none.
+class Radio:
+	def __init__(self, mac, nwk=None, pan=None):
+		self.addr = [mac, nwk, pan]
+		self.device = None
+
+	def mac(self):
+		return self.addr[0]
+
+	def address(self, new_nwk=None):
+		if new_nwk is not None:
+			self.addr[1] = new_nwk
+		return self.addr[1]
+
+	def pan(self, new_pan=None):
+		if new_pan is not None:
+			self.addr[2] = new_pan
+		return self.addr[2]
+
+	def rx(self):
+		return None
+
+	def deliver(self, data):
+		if self.device is not None:
+			self.device.rx(bytearray(data))
+
+	def tx_done(self, ok, latency):
+		if self.device is not None:
+			self.device.tx_status(ok, latency)
+
+
+# A NIC on a serial port, through a Link that has already been set up
+# (and negotiated, if binary records are wanted). The port is read when
+# the event loop sees that it is readable.
+class SerialRadio(Radio):
+	def __init__(self, link, mac, nwk=None, pan=None, loop=None):
+		Radio.__init__(self, mac, nwk, pan)
+		if loop is None:
+			loop = asyncio.get_running_loop()
+		self.loop = loop
+		self.link = link
+		loop.add_reader(link.dev.fileno(), self.readable)
+		# frames that arrived while the link was negotiated
+		loop.call_soon(self.readable)
+		self.expiry = loop.call_later(link.tx_timeout, self.expire)
+
+	def close(self):
+		self.loop.remove_reader(self.link.dev.fileno())
+		self.expiry.cancel()
+
+	# Recover the credits for frames that the NIC never reported,
+	# even if it has gone quiet
+	def expire(self):
+		self.link.expire()
+		self.expiry = self.loop.call_later(self.link.tx_timeout, self.expire)
+
+	def readable(self):
+		if not self.link.ready():
+			return
+		for (timestamp, rssi, lqi, data) in self.link.frames():
+			self.deliver(data)
+
+	def tx(self, b):
+		self.link.send(b, self.tx_done)
+
+
+# A simulated radio. The frames that are sent are passed to the medium
+# function, and the ones that ask for an ACK are acked latency seconds
+# later, unless the ACK is lost, which happens with a probability of loss.
+# inject() delivers a frame as though it had been received.
+class SimRadio(Radio):
+	def __init__(self, mac, nwk=None, pan=None, medium=None, latency=0.002, loss=0.0, loop=None):
+		Radio.__init__(self, mac, nwk, pan)
+		if loop is None:
+			loop = asyncio.get_running_loop()
+		self.loop = loop
+		self.medium = medium
+		self.latency = latency
+		self.loss = loss
+		self.sent = 0
+
+	def inject(self, data):
+		self.loop.call_soon(self.deliver, bytes(data))
+
+	def tx(self, b):
+		self.sent += 1
+		data = bytes(b)
+		if self.medium is not None:
+			self.medium(data)
+		# the ack request bit in the FCF, and the MAC sequence number
+		if not data[0] & 0x20 or random.random() < self.loss:
+			return
+		ack = IEEE802154.IEEE802154(
+			frame_type	= IEEE802154.FRAME_TYPE_ACK,
+			seq		= data[2],
+		).serialize()
+		self.loop.call_later(self.latency, self.deliver, ack)
+
+
+# A NWK data frame that has arrived. The NWK objects on the receive path
+# are recycled, so the fields are copied out of it.
+class Message:
+	__slots__ = (
+		"src",
+		"dst",
+		"seq",
+		"radius",
+		"ext_src",
+		"valid",
+		"payload",
+		"aps",
+	)
+
+	def __init__(self, nwk):
+		self.src = nwk.src
+		self.dst = nwk.dst
+		self.seq = nwk.seq
+		self.radius = nwk.radius
+		self.ext_src = None
+		if nwk.ext_src is not None:
+			self.ext_src = bytes(nwk.ext_src)
+		self.valid = nwk.valid
+		self.payload = bytes(nwk.payload)
+		self.aps = None
+		if self.valid:
+			try:
+				self.aps = ZigbeeApplication.ZigbeeApplication(data=self.payload)
+			except:
+				pass
+
+	def __str__(self):
+		return "Message(src=0x%04x, dst=0x%04x, seq=%d, valid=%s, aps=%s)" % (
+			self.src,
+			self.dst,
+			self.seq,
+			self.valid,
+			self.aps,
+		)
+
+
+# An IEEEDevice and NetworkDevice on the running event loop. Received
+# messages are queued for the async iterator; if nothing is reading
+# them and the queue fills up, the new ones are counted and dropped.
+class NetworkDevice:
+	def __init__(self, radio, router=None, seq=0, queue_size=256, loop=None):
+		if loop is None:
+			loop = asyncio.get_running_loop()
+		self.loop = loop
+		self.sched = LoopScheduler(loop)
+		self.dev = Device.IEEEDevice(radio, router, sched=self.sched)
+		self.nwk = Device.NetworkDevice(self.dev, seq=seq)
+		self.nwk.handler = self.handler
+		self.radio = radio
+		radio.device = self.dev
+
+		# one frame is left for the device's own data requests
+		self.room = asyncio.Semaphore(len(self.dev.txq.free) - 1)
+		self.messages = asyncio.Queue(queue_size)
+		self.dropped = 0
+
+	# Send a NWK frame, waiting until it has been acked if ack_req
+	# or sent if not. Raises SendError if it is not delivered.
+	async def send(self, dst, payload, **kwargs):
+		async with self.room:
+			result = self.loop.create_future()
+			def done(ok):
+				if not result.done():
+					result.set_result(ok)
+			self.nwk.tx(dst, payload, done=done, **kwargs)
+			if not await result:
+				raise SendError("NWK %04x: not acked" % (dst))
+
+	def handler(self, nwkdev, nwk):
+		try:
+			self.messages.put_nowait(Message(nwk))
+		except asyncio.QueueFull:
+			self.dropped += 1
+
+	async def recv(self):
+		return await self.messages.get()
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		return await self.messages.get()
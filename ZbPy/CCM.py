@@ -22,6 +22,10 @@ def decrypt(auth, message, mic, nonce, aes, validate=True):
 	if len(nonce) != 16:
 		raise ValueError("Nonce must be 16 bytes")
 
+	# let the cipher backend do all of the blocks if it can
+	if hasattr(aes, "ctr"):
+		return decrypt_native(auth, message, mic, nonce, aes, validate)
+
 	# decrypt the MIC block in place if there is a MIC
 	if validate:
 		xor = aes.encrypt(nonce)
@@ -99,6 +103,9 @@ def encrypt(auth, message, nonce, aes):
 	if len(nonce) != 16:
 		raise ValueError("Nonce must be 16 bytes")
 
+	if hasattr(aes, "ctr"):
+		return encrypt_native(auth, message, nonce, aes)
+
 	# Generate the first cipher block B0
 	# and run in CBC mode to compute the MIC
 	xor = bytearray(16)
@@ -160,3 +167,120 @@ def encrypt(auth, message, nonce, aes):
 
 	# return the encrypted MIC
 	return mic
+
+
+# XOR two buffers as big integers instead of byte-by-byte;
+# b must be at least as long as a.
+def _xor(a, b):
+	n = len(a)
+	return (int.from_bytes(a, "big") ^ int.from_bytes(b[0:n], "big")).to_bytes(n, "big")
+
+# Build the complete CBC-MAC input for CCM*: the B0 block, the length
+# prefixed auth data padded to a block and the message padded to a block.
+# decrypt() only sets the Adata flag if there is auth data, while
+# encrypt() always sets it, so the caller selects the flag.
+def _mac_input(auth, message, nonce, adata):
+	l_m = len(message)
+	l_a = len(auth)
+
+	b = bytearray(16)
+	b[0] = 1 << 3 # int((4 - 2)/2) << 3
+	if adata:
+		b[0] |= 0x40
+	b[0] |= 1
+	b[1:14] = nonce[1:14] # src addr and counter
+	b[14] = (l_m >> 8) & 0xFF
+	b[15] = (l_m >> 0) & 0xFF
+
+	b.append((l_a >> 8) & 0xFF)
+	b.append((l_a >> 0) & 0xFF)
+	b.extend(auth)
+	b.extend(bytes(-len(b) & 15))
+
+	b.extend(message)
+	b.extend(bytes(-len(b) & 15))
+
+	return b
+
+
+# When the cipher backend has native counter and CBC modes, the whole
+# keystream is one CTR call and the MIC is one CBC call instead of a
+# Python call per block. The results are identical to decrypt() and
+# encrypt(), except that the nonce is not modified.
+# The MIC is encrypted with the counter from the nonce (normally 0)
+# and the message starts at the next counter value.
+def decrypt_native(auth, message, mic, nonce, aes, validate=True):
+	l_m = len(message)
+	xor = aes.ctr(nonce, bytes(mic) + bytes(12) + bytes(message))
+	message[0:l_m] = xor[16:16+l_m]
+
+	if not validate:
+		return True
+
+	mic[0:4] = xor[0:4]
+	xor = aes.cbc_mac(_mac_input(auth, message, nonce, len(auth) != 0))
+	return xor[0:4] == bytes(mic)
+
+def encrypt_native(auth, message, nonce, aes):
+	l_m = len(message)
+	mic = aes.cbc_mac(_mac_input(auth, message, nonce, True))[0:4]
+	xor = aes.ctr(nonce, mic + bytes(12) + bytes(message))
+	message[0:l_m] = xor[16:16+l_m]
+	return bytearray(xor[0:4])
+
+
+# Decrypt a batch of messages in place. Each frame is a tuple of
+# (auth, message, mic, nonce) with the same meaning as for decrypt(),
+# although the nonces are not modified.
+#
+# The AES work is grouped across all of the frames: a single ECB call
+# generates the counter mode keystream for every frame, and the CBC-MAC
+# chains are run in lockstep with one ECB call per block position.
+# Returns a list of validity flags, one per frame.
+def decrypt_many(frames, aes, validate=True):
+	# counter blocks A0 (for the MIC) through An for every frame
+	ctr = bytearray()
+	for auth, message, mic, nonce in frames:
+		if len(mic) != 4:
+			raise ValueError("MIC must be 4 bytes")
+		if len(nonce) != 16:
+			raise ValueError("Nonce must be 16 bytes")
+		a = bytearray(nonce)
+		for i in range((len(message) + 15) // 16 + 1):
+			a[15] = (nonce[15] + i) & 0xFF
+			ctr.extend(a)
+
+	xor = aes.encrypt_blocks(ctr)
+
+	# apply the keystream a whole message at a time
+	off = 0
+	for auth, message, mic, nonce in frames:
+		if validate:
+			mic[0:4] = _xor(mic, xor[off:off+16])
+		off += 16
+		l_m = len(message)
+		message[0:l_m] = _xor(message, xor[off:off+l_m])
+		off += (l_m + 15) & ~15
+
+	if not validate:
+		return [True] * len(frames)
+
+	# check the message integrity codes with the messy CCM*,
+	# computing one block of every chain per AES call
+	macs = [_mac_input(f[0], f[1], f[3], len(f[0]) != 0) for f in frames]
+	state = [bytes(16)] * len(frames)
+	max_len = 0
+	for b in macs:
+		if len(b) > max_len:
+			max_len = len(b)
+
+	for i in range(0, max_len, 16):
+		live = [k for k in range(len(macs)) if len(macs[k]) > i]
+		blocks = bytearray()
+		for k in live:
+			blocks.extend(_xor(state[k], macs[k][i:i+16]))
+		xor = aes.encrypt_blocks(blocks)
+		for n in range(len(live)):
+			state[live[n]] = xor[16*n:16*n+16]
+
+	return [state[k][0:4] == bytes(frames[k][2]) for k in range(len(frames))]
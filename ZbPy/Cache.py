@@ -0,0 +1,52 @@
+# Bounded least-recently-used cache.
+# The hit, miss and eviction counters are kept so that the
+# size can be tuned for the traffic that is being processed.
+try:
+	from collections import OrderedDict
+except:
+	from ucollections import OrderedDict
+
+class LRU:
+	def __init__(self, size=1024):
+		self.size = size
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __str__(self):
+		return "LRU(size=%d/%d, hits=%d, misses=%d, evictions=%d)" % (
+			len(self.entries),
+			self.size,
+			self.hits,
+			self.misses,
+			self.evictions,
+		)
+
+	# Returns None if the key is not in the cache
+	def get(self, key):
+		if key not in self.entries:
+			self.misses += 1
+			return None
+
+		# move it to the most recently used end
+		self.hits += 1
+		value = self.entries.pop(key)
+		self.entries[key] = value
+		return value
+
+	def put(self, key, value):
+		if key in self.entries:
+			self.entries.pop(key)
+		elif len(self.entries) >= self.size:
+			# the first entry is the least recently used
+			del self.entries[next(iter(self.entries))]
+			self.evictions += 1
+
+		self.entries[key] = value
+
+	def clear(self):
+		self.entries = OrderedDict()
@@ -0,0 +1,478 @@
+# Columnar batch decoding of captures for analysis.
+# Instead of a tree of layer objects per frame, decode() returns a dict
+# of columns with one entry per frame, which can be turned into a numpy
+# structured array with to_array().
+#
+# With numpy the MAC, NWK and NWK security headers are decoded for all of
+# the frames at once: the frames are copied into a zero padded matrix
+# and the field offsets, which only depend on the frame control fields,
+# are computed as arrays and used to gather the fields. Without numpy the
+# same columns are filled in as lists, one frame at a time. The two
+# must agree; "python3 -m ZbPy.Columns --check" compares them.
+#
+# The APS and ZCL headers are encrypted in most frames, so those columns
+# are filled in per frame after a batched ZigbeeNetwork.deserialize_many()
+# and only if decrypt is True.
+#
+# This is only for the host; it does not run on MicroPython.
+from ZbPy import IEEE802154
+from ZbPy import ZigbeeNetwork
+from ZbPy import ZigbeeApplication
+from ZbPy import ZigbeeCluster
+from ZbPy import ZCL
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Column names and numpy types. Fields that are not in a frame are -1,
+# except for the 64-bit extended addresses which are 0 and the ZCL
+# command name which is empty.
+FIELDS = [
+	("length",		"i2"),
+	("frame_type",		"i1"),
+	("seq",			"i2"),
+	("dst_pan",		"i4"),
+	("dst",			"i4"),
+	("dst_long",		"u8"),
+	("src_pan",		"i4"),
+	("src",			"i4"),
+	("src_long",		"u8"),
+	("nwk_frame_type",	"i1"),
+	("nwk_dst",		"i4"),
+	("nwk_src",		"i4"),
+	("nwk_radius",		"i2"),
+	("nwk_seq",		"i2"),
+	("nwk_ext_dst",		"u8"),
+	("nwk_ext_src",		"u8"),
+	("security",		"i1"),
+	("sec_key",		"i1"),
+	("sec_counter",		"i8"),
+	("valid",		"i1"),
+	("aps_frame_type",	"i1"),
+	("aps_dst",		"i4"),
+	("aps_src",		"i2"),
+	("cluster",		"i4"),
+	("profile",		"i4"),
+	("aps_seq",		"i2"),
+	("zcl_command",		"i2"),
+	("command",		"U32"),
+]
+
+# Bytes of zero padding after the longest frame, enough that gathering
+# the largest possible headers never reads past the end of a row
+PADDING = 64
+
+# Length of the IEEE 802.15.4 addresses for each address mode
+ADDR_LEN = (0, 0, 2, 8)
+
+
+# Decode a list of raw IEEE 802.15.4 frames into a dict of columns.
+# The frames are not modified. If decrypt is False, then only the
+# header columns are filled in and the rest are -1.
+def decode(datas, aes=None, decrypt=True, validate=True):
+	if numpy is not None:
+		columns = _headers_numpy(datas)
+	else:
+		columns = _headers(datas)
+
+	if decrypt:
+		_payloads(columns, datas, aes, validate)
+
+	return columns
+
+# Convert a dict of columns into a numpy structured array
+def to_array(columns):
+	n = len(columns["length"])
+	array = numpy.zeros(n, dtype=FIELDS)
+	for (name, dtype) in FIELDS:
+		array[name] = columns[name]
+	return array
+
+def _empty(n):
+	columns = {}
+	for (name, dtype) in FIELDS:
+		if dtype == "u8":
+			value = 0
+		elif dtype[0] == "U":
+			value = ""
+		else:
+			value = -1
+
+		if numpy is not None:
+			columns[name] = numpy.full(n, value, dtype=dtype)
+		else:
+			columns[name] = [value] * n
+	return columns
+
+# Little endian extended address as an integer
+def _eui64(b):
+	if b is None:
+		return 0
+	return int.from_bytes(bytes(b), "little")
+
+
+# Fill in the header columns one frame at a time with the per-FCF decoders
+def _headers(datas):
+	columns = _empty(len(datas))
+	ieee = IEEE802154.IEEE802154()
+
+	for i in range(len(datas)):
+		data = datas[i]
+		columns["length"][i] = len(data)
+		try:
+			ieee.deserialize(data)
+		except:
+			continue
+
+		columns["frame_type"][i] = ieee.frame_type
+		columns["seq"][i] = ieee.seq
+		for name in ("dst_pan", "src_pan"):
+			value = getattr(ieee, name)
+			if value is not None:
+				columns[name][i] = value
+		for name in ("dst", "src"):
+			value = getattr(ieee, name)
+			if type(value) is int:
+				columns[name][i] = value
+			elif value is not None:
+				columns[name + "_long"][i] = _eui64(value)
+
+		b = ieee.payload
+		if ieee.frame_type != IEEE802154.FRAME_TYPE_DATA \
+		or len(b) < 8:
+			continue
+
+		# the NWK header fields, without preparing the decryption
+		d = ZigbeeNetwork.decoder((b[1] << 8) | (b[0] << 0))
+		j = d.length
+		if len(b) < j:
+			continue
+
+		columns["nwk_frame_type"][i] = d.frame_type
+		(
+			columns["nwk_dst"][i],
+			columns["nwk_src"][i],
+			columns["nwk_radius"][i],
+			columns["nwk_seq"][i],
+		) = ZigbeeNetwork.header(b, 2)
+		if d.ext_dst is not None:
+			columns["nwk_ext_dst"][i] = _eui64(b[d.ext_dst:d.ext_dst+8])
+		if d.ext_src is not None:
+			columns["nwk_ext_src"][i] = _eui64(b[d.ext_src:d.ext_src+8])
+		columns["security"][i] = d.security
+
+		# the security header, as in ZigbeeNetwork.ccm_prepare()
+		if not d.security or len(b) < j + 1:
+			continue
+		sec_hdr = b[j]
+		ext_src = None
+		if sec_hdr & 0x20:
+			ext_src = b[j+5:j+13]
+		if len(b) < j + 10 + (8 if ext_src is not None else 0):
+			continue
+
+		columns["sec_key"][i] = (sec_hdr >> 3) & 3
+		columns["sec_counter"][i] = int.from_bytes(bytes(b[j+1:j+5]), "little")
+		columns["nwk_ext_src"][i] = _eui64(ext_src)
+
+	return columns
+
+
+# Fill in the header columns for all of the frames with numpy
+def _headers_numpy(datas):
+	n = len(datas)
+	columns = _empty(n)
+	if n == 0:
+		return columns
+
+	# copy the frames into the rows of a zero padded matrix
+	lengths = numpy.fromiter((len(data) for data in datas), dtype=numpy.int64, count=n)
+	m = numpy.zeros((n, int(lengths.max()) + PADDING), dtype=numpy.uint8)
+	flat = numpy.frombuffer(b"".join([bytes(data) for data in datas]), dtype=numpy.uint8)
+	starts = numpy.cumsum(lengths) - lengths
+	m[numpy.repeat(numpy.arange(n), lengths),
+	  numpy.arange(len(flat)) - numpy.repeat(starts, lengths)] = flat
+
+	rows = numpy.arange(n)
+	def u8(off):
+		return m[rows, off].astype(numpy.int64)
+	def u16(off):
+		return u8(off) | (u8(off+1) << 8)
+	def u32(off):
+		return u16(off) | (u16(off+2) << 16)
+	def u64(off):
+		x = numpy.zeros(n, dtype=numpy.uint64)
+		for k in range(8):
+			x |= m[rows, off+k].astype(numpy.uint64) << numpy.uint64(8 * k)
+		return x
+	where = numpy.where
+	addr_len = numpy.array(ADDR_LEN)
+
+	columns["length"][:] = lengths
+
+	# IEEE 802.15.4 header, following the same rules as IEEE802154.Decoder
+	fcf = u16(0)
+	frame_type = fcf & 7
+	dst_mode = (fcf >> 10) & 3
+	src_mode = (fcf >> 14) & 3
+	compressed = ((fcf >> 6) & 1) != 0
+
+	off = numpy.full(n, 3, dtype=numpy.int64)
+	has_dst_pan = dst_mode != 0
+	dst_pan = where(has_dst_pan, u16(off), -1)
+	off += 2 * has_dst_pan
+	dst = where(dst_mode == 2, u16(off), -1)
+	dst_long = where(dst_mode == 3, u64(off), 0)
+	off += addr_len[dst_mode]
+
+	has_src_pan = (src_mode != 0) & ~compressed
+	src_pan = where(has_src_pan, u16(off), where(src_mode != 0, dst_pan, -1))
+	off += 2 * has_src_pan
+	src = where(src_mode == 2, u16(off), -1)
+	src_long = where(src_mode == 3, u64(off), 0)
+	off += addr_len[src_mode]
+	off += frame_type == IEEE802154.FRAME_TYPE_CMD
+
+	# frames that are too short for their header, or that have a
+	# reserved address mode, only have the length column
+	ok = (lengths >= 3) & (lengths >= off) & (dst_mode != 1) & (src_mode != 1)
+
+	columns["frame_type"][ok] = frame_type[ok]
+	columns["seq"][ok] = u8(2)[ok]
+	columns["dst_pan"][ok] = dst_pan[ok]
+	columns["dst"][ok] = dst[ok]
+	columns["dst_long"][ok] = dst_long[ok]
+	columns["src_pan"][ok] = src_pan[ok]
+	columns["src"][ok] = src[ok]
+	columns["src_long"][ok] = src_long[ok]
+
+	# NWK header, following the same rules as ZigbeeNetwork.Decoder
+	nwk = off
+	fcf = u16(nwk)
+	security = (fcf >> 9) & 1
+	ext_dst = (fcf >> 11) & 1
+	ext_src = (fcf >> 12) & 1
+
+	off = nwk + 8
+	nwk_ext_dst = where(ext_dst != 0, u64(off), 0)
+	off += 8 * ext_dst
+	nwk_ext_src = where(ext_src != 0, u64(off), 0)
+	off += 8 * ext_src
+
+	ok &= (frame_type == IEEE802154.FRAME_TYPE_DATA) & (lengths >= off)
+
+	columns["nwk_frame_type"][ok] = (fcf & 3)[ok]
+	columns["nwk_dst"][ok] = u16(nwk + 2)[ok]
+	columns["nwk_src"][ok] = u16(nwk + 4)[ok]
+	columns["nwk_radius"][ok] = u8(nwk + 6)[ok]
+	columns["nwk_seq"][ok] = u8(nwk + 7)[ok]
+	columns["nwk_ext_dst"][ok] = nwk_ext_dst[ok]
+	columns["nwk_ext_src"][ok] = nwk_ext_src[ok]
+	columns["security"][ok] = security[ok]
+
+	# NWK security header, with an optional extended source address
+	# that replaces the one in the NWK header
+	sec_hdr = u8(off)
+	nonce_src = (sec_hdr & 0x20) != 0
+	sec_len = 6 + 8 * nonce_src
+	ok &= (security != 0) & (lengths >= off + sec_len + 4)
+
+	columns["sec_key"][ok] = ((sec_hdr >> 3) & 3)[ok]
+	columns["sec_counter"][ok] = u32(off + 1)[ok]
+	columns["nwk_ext_src"][ok] = where(nonce_src, u64(off + 5), 0)[ok]
+
+	return columns
+
+
+# Decrypt the NWK data frames as a batch and fill in the validity,
+# APS and ZCL columns for each of them
+def _payloads(columns, datas, aes, validate):
+	if aes is None:
+		from ZbPy import Parser
+		aes = Parser.keys
+
+	indices = []
+	payloads = []
+	ieee = IEEE802154.IEEE802154()
+	for i in range(len(datas)):
+		if columns["nwk_frame_type"][i] != ZigbeeNetwork.FRAME_TYPE_DATA:
+			continue
+		# a copy, since the decryption is done in place
+		ieee.deserialize(memoryview(bytearray(datas[i])))
+		indices.append(i)
+		payloads.append(ieee.payload)
+
+	nwks = ZigbeeNetwork.deserialize_many(payloads, aes, validate)
+
+	for k in range(len(indices)):
+		i = indices[k]
+		nwk = nwks[k]
+		columns["valid"][i] = 1 if nwk.valid else 0
+		if not nwk.valid:
+			continue
+
+		try:
+			aps = ZigbeeApplication.ZigbeeApplication(data=nwk.payload)
+		except:
+			continue
+
+		columns["aps_frame_type"][i] = aps.frame_type
+		columns["aps_dst"][i] = aps.dst
+		columns["aps_src"][i] = aps.src
+		columns["cluster"][i] = aps.cluster
+		columns["profile"][i] = aps.profile
+		columns["aps_seq"][i] = aps.seq
+
+		if aps.frame_type != ZigbeeApplication.FRAME_TYPE_DATA \
+		or aps.profile != ZigbeeApplication.PROFILE_HOME:
+			continue
+
+		try:
+			zcl = ZigbeeCluster.ZigbeeCluster(data=aps.payload)
+			columns["zcl_command"][i] = zcl.command
+			cmd = ZCL.ZCL(cluster=aps.cluster, command=zcl.command)
+			if cmd.deserialize(zcl.payload):
+				columns["command"][i] = cmd.name
+		except:
+			pass
+
+
+# Frames with every combination of MAC frame type, address modes and
+# PAN ID compression, and for the data frames every combination of the
+# NWK extended addresses and security header, for check()
+def samples():
+	payloads = []
+	for ext in range(4):
+		for sec_hdr in (None, 0x08, 0x28):
+			fcf = 0x0008 | (ext << 11)
+			if sec_hdr is not None:
+				fcf |= 1 << 9
+			b = bytes([fcf & 0xFF, fcf >> 8, 0x34, 0x12, 0x78, 0x56, 30, 0x42])
+			if ext & 1:
+				b += bytes(range(0x10, 0x18))
+			if ext & 2:
+				b += bytes(range(0x20, 0x28))
+			if sec_hdr is not None:
+				b += bytes([sec_hdr, 0x01, 0x02, 0x03, 0x04])
+				if sec_hdr & 0x20:
+					b += bytes(range(0x30, 0x38))
+				b += bytes([0x00]) + bytes(range(0x40, 0x48))
+			payloads.append(b)
+
+	datas = []
+	for frame_type in range(4):
+		for dst_mode in range(4):
+			for src_mode in range(4):
+				for compressed in range(2):
+					fcf = frame_type | (compressed << 6) | (dst_mode << 10) | (src_mode << 14)
+					b = bytes([fcf & 0xFF, fcf >> 8, 0x17])
+					if dst_mode != 0:
+						b += bytes([0x62, 0x1A]) + bytes(range(0x50, 0x50 + ADDR_LEN[dst_mode]))
+					if src_mode != 0:
+						if not compressed:
+							b += bytes([0x63, 0x1A])
+						b += bytes(range(0x60, 0x60 + ADDR_LEN[src_mode]))
+					if frame_type == IEEE802154.FRAME_TYPE_CMD:
+						b += bytes([IEEE802154.COMMAND_DATA_REQUEST])
+					if frame_type == IEEE802154.FRAME_TYPE_DATA:
+						for payload in payloads:
+							datas.append(b + payload)
+					else:
+						datas.append(b + bytes([0x01, 0x02]))
+	return datas
+
+# Compare the numpy header decoding with the one frame at a time
+# decoding, on the frames and on copies of them that are truncated at
+# every length or have the reserved address modes. Returns a list of
+# (column, frame, numpy value, list value) for the differences.
+def check(datas):
+	datas = list(datas)
+	for data in datas[:]:
+		data = bytes(data)
+		for n in range(len(data)):
+			datas.append(data[0:n])
+		if len(data) >= 2:
+			# dst_mode and src_mode 1 are reserved
+			datas.append(data[0:1] + bytes([data[1] & 0xF3 | 0x04]) + data[2:])
+			datas.append(data[0:1] + bytes([data[1] & 0x3F | 0x40]) + data[2:])
+
+	fast = _headers_numpy(datas)
+	slow = _headers(datas)
+	diffs = []
+	for (name, dtype) in FIELDS:
+		for i in range(len(datas)):
+			if fast[name][i] != slow[name][i]:
+				diffs.append((name, i, fast[name][i], slow[name][i]))
+	return diffs
+
+# Run check() on the samples and the frames of any pcap files,
+# returning the number of differences
+# Run with "python3 -m ZbPy.Columns --check [capture.pcap...]"
+def run_check(filenames):
+	from ZbPy import Pcap
+
+	if numpy is None:
+		print("numpy is not installed; there is nothing to check")
+		return 0
+
+	sources = [("samples", samples())]
+	for filename in filenames:
+		datas = []
+		for (timestamp, linktype, data) in Pcap.read(filename):
+			if linktype == Pcap.LINKTYPE_IEEE802_15_4_WITHFCS:
+				data = data[0:len(data)-2]
+			datas.append(data)
+		sources.append((filename, datas))
+
+	total = 0
+	for (name, datas) in sources:
+		diffs = check(datas)
+		for (column, i, fast, slow) in diffs[0:10]:
+			print("%s: frame %d %s=%s with numpy, %s without" % (name, i, column, fast, slow))
+		print("%s: %d frames, %d numpy header differences" % (name, len(datas), len(diffs)))
+		total += len(diffs)
+	return total
+
+# Decode pcap files in chunks and report the decoding rate
+# Run with "python3 -m ZbPy.Columns capture.pcap..."
+def benchmark(filenames, chunk=100000, decrypt=True):
+	import time
+	from ZbPy import Pcap
+
+	frames = 0
+	valid = 0
+	start = time.time()
+	for filename in filenames:
+		datas = []
+		for (timestamp, linktype, data) in Pcap.read(filename):
+			if linktype == Pcap.LINKTYPE_IEEE802_15_4_WITHFCS:
+				data = data[0:len(data)-2]
+			datas.append(data)
+			if len(datas) < chunk:
+				continue
+			columns = decode(datas, decrypt=decrypt)
+			frames += len(datas)
+			valid += sum(1 for v in columns["valid"] if v == 1)
+			datas = []
+
+		columns = decode(datas, decrypt=decrypt)
+		frames += len(datas)
+		valid += sum(1 for v in columns["valid"] if v == 1)
+
+	elapsed = time.time() - start
+	print("%d frames, %d valid NWK data frames, %.0f frames/sec%s" % (
+		frames,
+		valid,
+		frames / elapsed,
+		"" if numpy is not None else " (without numpy)",
+	))
+
+if __name__ == "__main__":
+	import sys
+	if len(sys.argv) > 1 and sys.argv[1] == "--check":
+		if run_check(sys.argv[2:]) != 0:
+			sys.exit(1)
+	else:
+		benchmark(sys.argv[1:])
@@ -2,64 +2,87 @@
 #
 #
 
-from ZbPy import AES
 from ZbPy import IEEE802154
 from ZbPy import ZigbeeNetwork
 from ZbPy import ZigbeeApplication
 from ZbPy import ZigbeeCluster
 from ZbPy import ZCL
 from ZbPy import Parser
+from ZbPy import KeyRing
+from ZbPy import Pool
+from ZbPy import Replay
+from ZbPy import TxQueue
+from ZbPy import Scheduler
 
 from binascii import unhexlify, hexlify
 from struct import pack, unpack
 
-try:
-	from time import ticks_us
-except:
-	import time
-	def ticks_us():
-		return int(time.time() * 1e6)
-
 
 class IEEEDevice:
 	data_request_timeout = 1000000 # usec == 100 ms
 	retransmit_timeout = 1000000 # usec == 100 ms
 
-	def __init__(self, radio, router = None):
+	def __init__(self, radio, router = None, sched = None):
+		if sched is None:
+			sched = Scheduler.Scheduler()
+		self.sched = sched
 		self.radio = radio
 		self.router = router
 		self.seq = 0
-		self.pending_seq = None
 		self.pending_data = None
 		self.handler = lambda x: None
 		self.joined = lambda x: None
-		self.seqs = {}
+		self.replay = Replay.Replay()
 		self.verbose = False
+		self.pool = Pool.Pool(IEEE802154.IEEE802154)
+
+		# all of the layers of an outgoing frame are serialized
+		# directly into a buffer in the queue, which holds it
+		# until it is acked or runs out of retries
+		self.txq = TxQueue.TxQueue(radio, sched,
+			timeout = self.retransmit_timeout,
+			fail = self.tx_failed,
+		)
 
 		self.tx_fail = 0
-		self.last_data_request = 0
-		self.last_tx = 0
+		# seconds from radio.tx() until the last frame was sent,
+		# for radios that report it
+		self.tx_latency = None
 		self.join_failed = False
 
+		# if we are hoping for more data, and we are not waiting for
+		# an ack, go ahead and send a data request
+		self.data_request_timer = sched.every(self.data_request_timeout, self.data_request_tick)
+
 	def rx(self, data):
 		if data is None or len(data) < 2: # or len(data) < 2 or len(data) & 1 != 0:
 			self.tick()
 			return
 
+		# decode the layers as views into the receive buffer
+		if type(data) is bytearray:
+			data = memoryview(data)
+
+		# the frame object is recycled once the handlers return,
+		# so they must not hold on to it
+		ieee = self.pool.get()
+		try:
+			return self.rx_ieee(ieee, data)
+		finally:
+			self.pool.put(ieee)
+
+	def rx_ieee(self, ieee, data):
 		try:
-			ieee = IEEE802154.IEEE802154(data=data)
+			ieee.deserialize(data)
 
 			# check for duplicates, using the short address
 			# long address duplicates will be processed
-			if type(ieee.src) is int:
-				if ieee.src in self.seqs \
-				and self.seqs[ieee.src] == ieee.seq:
-					return
-
-				self.seqs[ieee.src] = ieee.seq
+			if self.replay.ieee(ieee):
+				return
 
+			# the parser decrypts in place, so give it a copy
 			if self.verbose:
-				print("RX: " + str(Parser.parse(data)[0]))
+				print("RX: " + str(Parser.parse(bytearray(data))[0]))
 
 		except Exception as e:
 			print("IEEE error: " + str(hexlify(data)))
@@ -77,7 +100,7 @@ class IEEEDevice:
 			return self.handler(ieee.payload)
 		else:
 			# should signal a wtf?
-			print("RX: " + str(Parser.parse(data)[0]))
+			print("RX: " + str(Parser.parse(bytearray(data))[0]))
 			pass
 
 
@@ -86,33 +109,26 @@ class IEEEDevice:
 		if pkt is not None:
 			self.rx(pkt)
 
-		now = ticks_us()
+		self.sched.run()
 
-		# if we are hoping for more data, and we are not waiting for
-		# an ack, go ahead and send a data request
-		if self.pending_data \
-		and now - self.last_data_request > self.data_request_timeout \
-		and self.pending_seq is None:
+	def data_request_tick(self):
+		if self.pending_data and self.idle():
 			self.data_request()
-			self.last_data_request = now
-
-		if self.pending_seq is None:
-			return
 
-		if self.retries == 0:
-			# todo: log that the transmit failed to ever be acked
-			self.pending_seq = None
-			self.tx_fail += 1
-			return
+	# Returns True if nothing is waiting to be sent or acked
+	def idle(self):
+		return not self.txq.busy()
 
-		if now - self.last_tx > self.retransmit_timeout:
-			print("RETX %02x %d" % (self.pending_seq, self.retries))
-			self.last_tx = now
-			self.radio.tx(self.last_pkt)
-			self.retries -= 1
+	# Block until the radio has a frame or the next timer is due.
+	# Radios without a wait(timeout_usec) are polled instead.
+	def wait(self):
+		wait = getattr(self.radio, "wait", None)
+		if wait is not None:
+			wait(self.sched.timeout())
 
 	def loop(self):
 		while True:
+			self.wait()
 			self.tick()
 
 	# Send an ACK for a sequence number, indicating that it has
@@ -127,7 +143,7 @@ class IEEEDevice:
 		#print("ACKING %02x" % (ack_seq))
 
 	# Send a data request to say "yo we're ready for stuff"
-	def data_request(self):
+	def data_request(self, done=None):
 		pan = self.radio.pan()
 		src = self.radio.address()
 		if src is None:
@@ -141,11 +157,12 @@ class IEEEDevice:
 			src		= src,
 			src_pan		= pan,
 			ack_req		= True,
-		))
+		), done)
 
 	# Send a packet from the upper layer, wrapping it with the
-	# IEEE 802.15.4 header, setting the flags as requested
-	def tx(self, payload, dst = None, ack_req = False, long_addr = False):
+	# IEEE 802.15.4 header, setting the flags as requested.
+	# done is called with whether the frame was delivered.
+	def tx(self, payload, dst = None, ack_req = False, long_addr = False, done = None):
 		pan = self.radio.pan()
 		src = self.radio.address()
 		if src is None:
@@ -159,9 +176,20 @@ class IEEEDevice:
 			src_pan		= pan,
 			ack_req		= ack_req,
 			payload		= payload,
-		))
+		), done)
+
+	# Queue a frame, with MAC commands ahead of data unless a
+	# priority is given, and send it if the queue has room.
+	# Returns False if the queue is full.
+	def tx_ieee(self, pkt, done = None, prio = None):
+		frame = self.txq.get()
+		if frame is None:
+			print("TX QUEUE FULL")
+			self.tx_failed(None)
+			if done is not None:
+				done(False)
+			return False
 
-	def tx_ieee(self, pkt):
 		pkt.seq = self.seq
 		self.seq = (self.seq + 1) & 0x3F
 
@@ -169,17 +197,37 @@ class IEEEDevice:
 		if self.verbose:
 			print("TX: ", pkt)
 
-		self.last_pkt = pkt.serialize()
-		if pkt.command != IEEE802154.COMMAND_DATA_REQUEST:
-			print("TX: " + str(Parser.parse(self.last_pkt)[0]))
-		self.radio.tx(self.last_pkt)
+		# the frame goes back to the queue if it can not be
+		# serialized, or the queue would run out of buffers
+		try:
+			frame.length = pkt.serialize_into(frame.buf, 0)
+			if pkt.command != IEEE802154.COMMAND_DATA_REQUEST:
+				# parse a copy, since decryption is done in place
+				print("TX: " + str(Parser.parse(bytearray(frame.data()))[0]))
+		except:
+			self.txq.release(frame)
+			raise
+
+		if prio is None:
+			if pkt.frame_type == IEEE802154.FRAME_TYPE_CMD:
+				prio = TxQueue.PRIO_CMD
+			else:
+				prio = TxQueue.PRIO_DATA
+
+		self.txq.put(frame, pkt.seq, prio, pkt.ack_req, done)
+		self.txq.send()
+		return True
 
-		if pkt.ack_req:
-			self.last_tx = ticks_us()
-			self.pending_seq = pkt.seq
-			self.retries = 3
-		else:
-			self.pending_seq = None
+	# A frame was never acked, or could not be queued
+	def tx_failed(self, seq):
+		self.tx_fail += 1
+
+	# Called by radios that report when a frame has been transmitted,
+	# with whether it made it onto the air and how long it took
+	def tx_status(self, ok, latency):
+		self.tx_latency = latency
+		if not ok:
+			self.tx_fail += 1
 
 	# Send a join request; we must know the PAN
 	# from the beacon before sending the join
@@ -213,12 +261,11 @@ class IEEEDevice:
 
 	# if we have a pending ACK for this sequence number, flag it as received
 	def handle_ack(self, ieee):
-		if ieee.seq == self.pending_seq:
+		if self.txq.ack(ieee.seq):
 			if self.verbose:
 				print("RX ACK %02x" % (ieee.seq))
-			self.pending_seq = None
 		else:
-			print("RX ACK %02x != expected %02x" % (ieee.seq, self.pending_seq))
+			print("RX ACK %02x not pending" % (ieee.seq))
 
 	# process a IEEE802154 command message to us
 	def handle_command(self, ieee):
@@ -268,8 +315,10 @@ class NetworkDevice:
 	# This is the "well known" zigbee2mqtt key.
 	# The Ikea gateway uses a different key that has to be learned
 	# by joining the network (not yet implemented)
+	# Other keys can be added to the key ring.
 	nwk_key = unhexlify(b"01030507090b0d0f00020406080a0c0d")
-	aes = AES.AES(nwk_key)
+	keys = KeyRing.KeyRing()
+	aes = keys.add(nwk_key)
 
 	# The addr is [mac, nwk, pan] and are set by outside processes
 
@@ -280,23 +329,32 @@ class NetworkDevice:
 		self.seq = 0 # this is the 8-bit sequence and wraps quickly
 		self.sec_seq = seq # should be read from a config file and be always incrementing
 
-		# Track the sequence numbers from other hosts
-		self.seqs = {}
+		# Track the sequence numbers from other hosts in the
+		# same filter as the MAC layer
+		self.replay = dev.replay
+
+		# recycled NWK objects for the receive path
+		self.pool = Pool.Pool(ZigbeeNetwork.ZigbeeNetwork, aes=self.keys)
 
 		# install our rx as the device's receive packet handler
 		dev.handler = self.rx
 		# todo: add handlers for aborted transactions, etc
 
-	# called by the IEEE device when a new network packet has arrived
+	# called by the IEEE device when a new network packet has arrived.
+	# The NWK object is recycled when the handler returns.
 	def rx(self, data):
+		nwk = self.pool.get()
 		try:
-			nwk = ZigbeeNetwork.ZigbeeNetwork(data=data, aes=self.aes)
-			# filter any dupes from this source
-			if nwk.src in self.seqs \
-			and self.seqs[nwk.src] == nwk.seq:
-				return
+			return self.rx_nwk(nwk, data)
+		finally:
+			self.pool.put(nwk)
 
-			self.seqs[nwk.src] = nwk.seq
+	def rx_nwk(self, nwk, data):
+		try:
+			nwk.deserialize(data)
+			# filter any dupes or replays from this source
+			if self.replay.nwk(nwk):
+				return
 
 			# don't print broadcast messages
 			if self.verbose \
@@ -319,9 +377,9 @@ class NetworkDevice:
 			print("NWK type %02x?" % (nwk.frame_type))
 
 
-	def tx(self, dst, payload, frame_type=ZigbeeNetwork.FRAME_TYPE_DATA, security=True, ack_req=True):
-		self.dev.tx(dst=dst, ack_req=ack_req, payload=ZigbeeNetwork.ZigbeeNetwork(
-			aes		= self.aes,
+	def tx(self, dst, payload, frame_type=ZigbeeNetwork.FRAME_TYPE_DATA, security=True, ack_req=True, done=None):
+		self.dev.tx(dst=dst, ack_req=ack_req, done=done, payload=ZigbeeNetwork.ZigbeeNetwork(
+			aes		= self.keys,
 			frame_type	= frame_type,
 			version		= 2,
 			radius		= 30,
@@ -335,7 +393,7 @@ class NetworkDevice:
 			sec_key_seq	= 0,
 			sec_seq		= pack("<I", self.sec_seq),
 			payload		= payload,
-		).serialize())
+		))
 
 		self.seq = (self.seq + 1) & 0x3F
 
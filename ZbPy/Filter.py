@@ -0,0 +1,355 @@
+# Frame filter expressions, such as
+#	cluster == 0x0008 and nwk_src == 0x3f15
+#	(frame_type == 1 or frame_type == 3) and not src_pan == 0x1a62
+#	name == OnOff.Toggle
+#
+# An expression is compiled into a tree of closures that is evaluated in
+# stages as the frame is decoded. The MAC and NWK fields are read from the
+# raw header bytes before anything else is done with the frame, and the
+# fields that need decryption are unknown at that point. Unknown fields
+# make a comparison None instead of True or False, which and/or/not pass
+# through (three valued logic), so a frame is only decrypted and decoded
+# if the header fields do not already rule it out.
+#
+# Fields of layers that the frame does not have never match.
+from ZbPy import IEEE802154
+from ZbPy import ZigbeeNetwork
+from ZbPy import ZigbeeApplication
+from ZbPy import ZigbeeCluster
+from ZbPy import ZCL
+
+STAGE_MAC = 0
+STAGE_NWK = 1
+STAGE_APS = 2
+STAGE_ZCL = 3
+
+# The layers of one frame that the fields are read from
+class Fields:
+	__slots__ = (
+		"data",
+		"stage",
+		"_mac",
+		"_nwk",
+		"aps",
+		"zcl",
+		"cmd",
+	)
+
+	def __init__(self, data):
+		self.data = data
+		self.stage = STAGE_NWK
+		self._mac = None
+		self._nwk = None
+		self.aps = None
+		self.zcl = None
+		self.cmd = None
+
+	# The IEEE802154 decoder and header values, or False if the
+	# frame is too short or has a reserved addressing mode
+	def mac(self):
+		if self._mac is None:
+			self._mac = False
+			b = self.data
+			try:
+				d = IEEE802154.decoder((b[1] << 8) | (b[0] << 0))
+				if len(b) >= d.length:
+					self._mac = (d, d.unpack(b, 2) + (None,))
+			except:
+				pass
+		return self._mac
+
+	# The ZigbeeNetwork decoder and (dst, src, radius, seq),
+	# or False if this is not a NWK frame
+	def nwk(self):
+		if self._nwk is None:
+			self._nwk = False
+			mac = self.mac()
+			b = self.data
+			if mac and mac[0].frame_type == IEEE802154.FRAME_TYPE_DATA \
+			and len(b) >= mac[0].length + 8:
+				j = mac[0].length
+				d = ZigbeeNetwork.decoder((b[j+1] << 8) | (b[j+0] << 0))
+				self._nwk = (d, ZigbeeNetwork.header(b, j+2))
+		return self._nwk
+
+	# Find the upper layers in a decoded tree, which stops at
+	# the first payload that is still raw bytes
+	def decoded(self, ieee):
+		self.stage = STAGE_ZCL
+		layer = ieee
+		while layer is not None:
+			if isinstance(layer, ZigbeeApplication.ZigbeeApplication):
+				self.aps = layer
+			elif isinstance(layer, ZigbeeCluster.ZigbeeCluster):
+				self.zcl = layer
+			elif isinstance(layer, ZCL.ZCL):
+				self.cmd = layer
+				break
+			layer = getattr(layer, "payload", None)
+
+def _mac_field(name):
+	def get(f):
+		mac = f.mac()
+		if not mac:
+			return None
+		return mac[1][getattr(mac[0], name)]
+	return get
+
+def _mac_seq(f):
+	mac = f.mac()
+	if not mac:
+		return None
+	return mac[1][0]
+
+def _mac_flag(name):
+	def get(f):
+		mac = f.mac()
+		if not mac:
+			return None
+		return int(getattr(mac[0], name))
+	return get
+
+def _nwk_field(index):
+	def get(f):
+		nwk = f.nwk()
+		if not nwk:
+			return None
+		return nwk[1][index]
+	return get
+
+def _nwk_flag(name):
+	def get(f):
+		nwk = f.nwk()
+		if not nwk:
+			return None
+		return getattr(nwk[0], name)
+	return get
+
+def _layer_field(layer, name):
+	def get(f):
+		obj = getattr(f, layer)
+		if obj is None:
+			return None
+		return getattr(obj, name)
+	return get
+
+# The stage at which each field is known and how to read it
+fields = {
+	"frame_type":	(STAGE_MAC, _mac_flag("frame_type")),
+	"ack_req":	(STAGE_MAC, _mac_flag("ack_req")),
+	"seq":		(STAGE_MAC, _mac_seq),
+	"dst_pan":	(STAGE_MAC, _mac_field("dst_pan")),
+	"dst":		(STAGE_MAC, _mac_field("dst")),
+	"src_pan":	(STAGE_MAC, _mac_field("src_pan")),
+	"src":		(STAGE_MAC, _mac_field("src")),
+	"command_id":	(STAGE_MAC, _mac_field("command")),
+	"nwk_type":	(STAGE_NWK, _nwk_flag("frame_type")),
+	"security":	(STAGE_NWK, _nwk_flag("security")),
+	"nwk_dst":	(STAGE_NWK, _nwk_field(0)),
+	"nwk_src":	(STAGE_NWK, _nwk_field(1)),
+	"radius":	(STAGE_NWK, _nwk_field(2)),
+	"nwk_seq":	(STAGE_NWK, _nwk_field(3)),
+	"aps_type":	(STAGE_APS, _layer_field("aps", "frame_type")),
+	"aps_dst":	(STAGE_APS, _layer_field("aps", "dst")),
+	"aps_src":	(STAGE_APS, _layer_field("aps", "src")),
+	"cluster":	(STAGE_APS, _layer_field("aps", "cluster")),
+	"profile":	(STAGE_APS, _layer_field("aps", "profile")),
+	"command":	(STAGE_ZCL, _layer_field("zcl", "command")),
+	"name":		(STAGE_ZCL, _layer_field("cmd", "name")),
+}
+
+operators = {
+	"==": lambda a, b: a == b,
+	"!=": lambda a, b: a != b,
+	"<": lambda a, b: a < b,
+	"<=": lambda a, b: a <= b,
+	">": lambda a, b: a > b,
+	">=": lambda a, b: a >= b,
+}
+
+
+# Split an expression into words, parentheses and operators
+def tokenize(expr):
+	tokens = []
+	i = 0
+	while i < len(expr):
+		c = expr[i]
+		if c in " \t\n":
+			i += 1
+		elif c in "()":
+			tokens.append(c)
+			i += 1
+		elif c in "=!<>":
+			j = i + 1
+			if j < len(expr) and expr[j] == "=":
+				j += 1
+			tokens.append(expr[i:j])
+			i = j
+		elif c in "&|":
+			j = i + 1
+			if j < len(expr) and expr[j] == c:
+				j += 1
+			tokens.append(expr[i:j])
+			i = j
+		elif c in "'\"":
+			j = expr.find(c, i + 1)
+			if j < 0:
+				raise ValueError("Unterminated string in filter")
+			tokens.append(expr[i:j+1])
+			i = j + 1
+		else:
+			j = i
+			while j < len(expr) and expr[j] not in " \t\n()=!<>&|'\"":
+				j += 1
+			tokens.append(expr[i:j])
+			i = j
+	return tokens
+
+def _value(token):
+	if token[0] in "'\"":
+		return token[1:-1]
+	try:
+		return int(token, 0)
+	except ValueError:
+		return token
+
+def _compare(stage, get, op, value):
+	def test(f):
+		if f.stage < stage:
+			return None
+		v = get(f)
+		if v is None:
+			return False
+		try:
+			return op(v, value)
+		except TypeError:
+			# comparing a number to a name
+			return False
+	return test
+
+def _and(a, b):
+	def test(f):
+		x = a(f)
+		if x is False:
+			return False
+		y = b(f)
+		if y is False:
+			return False
+		if x is None or y is None:
+			return None
+		return True
+	return test
+
+def _or(a, b):
+	def test(f):
+		x = a(f)
+		if x is True:
+			return True
+		y = b(f)
+		if y is True:
+			return True
+		if x is None or y is None:
+			return None
+		return False
+	return test
+
+def _not(a):
+	def test(f):
+		x = a(f)
+		if x is None:
+			return None
+		return not x
+	return test
+
+
+# Recursive descent parser for
+#	expr := term ("or" term)*
+#	term := factor ("and" factor)*
+#	factor := "not" factor | "(" expr ")" | field op value
+class Compiler:
+	def __init__(self, expr):
+		self.tokens = tokenize(expr)
+		self.pos = 0
+		self.stage = STAGE_MAC
+
+	def peek(self):
+		if self.pos < len(self.tokens):
+			return self.tokens[self.pos]
+		return None
+
+	def next(self):
+		token = self.peek()
+		if token is None:
+			raise ValueError("Unexpected end of filter")
+		self.pos += 1
+		return token
+
+	def compile(self):
+		test = self.expr()
+		if self.peek() is not None:
+			raise ValueError("Unexpected '" + self.peek() + "' in filter")
+		return test
+
+	def expr(self):
+		test = self.term()
+		while self.peek() in ("or", "||"):
+			self.next()
+			test = _or(test, self.term())
+		return test
+
+	def term(self):
+		test = self.factor()
+		while self.peek() in ("and", "&&"):
+			self.next()
+			test = _and(test, self.factor())
+		return test
+
+	def factor(self):
+		token = self.next()
+		if token in ("not", "!"):
+			return _not(self.factor())
+		if token == "(":
+			test = self.expr()
+			if self.next() != ")":
+				raise ValueError("Missing ')' in filter")
+			return test
+
+		if token not in fields:
+			raise ValueError("Unknown filter field '" + token + "'")
+		(stage, get) = fields[token]
+		op = self.next()
+		if op not in operators:
+			raise ValueError("Unknown filter operator '" + op + "'")
+		if stage > self.stage:
+			self.stage = stage
+		return _compare(stage, get, operators[op], _value(self.next()))
+
+
+class Filter:
+	def __init__(self, expr):
+		compiler = Compiler(expr)
+		self.expr = expr
+		self.test = compiler.compile()
+		# the last stage that any of the fields need
+		self.stage = compiler.stage
+
+	def __str__(self):
+		return "Filter(" + self.expr + ")"
+
+	# Check the raw frame headers, returning the Fields for the frame if
+	# it might match, or None if the frame can be discarded without
+	# decrypting or decoding it
+	def early(self, data):
+		f = Fields(data)
+		if self.test(f) is False:
+			return None
+		return f
+
+	# Check the Fields from early() once the frame has been decoded
+	# into ieee, returning True if it matches
+	def late(self, f, ieee):
+		if self.stage <= STAGE_NWK:
+			# early() had all of the fields, so it was a match
+			return True
+		f.decoded(ieee)
+		return self.test(f) is True
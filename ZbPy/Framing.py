@@ -0,0 +1,204 @@
+# Binary framing for the serial link between the NIC firmware and the host.
+#
+# The link starts out as hex lines. The host asks for binary framing by
+# sending the HELLO line; firmware that supports it replies with the
+# ACK line, followed by the period of its microsecond tick counter and
+# the number of transmit credits, and from then on both directions are
+# SLIP framed records:
+#
+#	END, type, body..., crc16 (little endian), END
+#
+# with END and ESC bytes in between escaped. The CRC is CRC-16/CCITT
+# (polynomial 0x1021, initial value 0xFFFF) over the type and body.
+# Received frames carry the firmware timestamp and the link quality:
+#
+#	RECORD_RX	ticks_us (u32), rssi (s8), lqi (u8), length (u8), frame
+#	RECORD_TEXT	status message from the firmware
+#	RECORD_TX	tag (u8), frame for the NIC to transmit
+#	RECORD_EXIT	return the link to hex lines
+#	RECORD_TX_STATUS	tag (u8), status (u8), usec from arrival to air (u32)
+#
+# Each credit is room for one frame in the firmware's transmit queue.
+# The host spends one for every RECORD_TX, and gets it back with the
+# RECORD_TX_STATUS that the firmware sends once the frame has been
+# transmitted, so it can send frames back to back without overrunning
+# the firmware.
+from struct import pack, pack_into, unpack_from
+
+HELLO = "!binary"
+ACK = "NIC: BINARY"
+
+END = 0xC0
+ESC = 0xDB
+ESC_END = 0xDC
+ESC_ESC = 0xDD
+
+RECORD_RX = 0x01
+RECORD_TEXT = 0x02
+RECORD_TX = 0x03
+RECORD_EXIT = 0x04
+RECORD_TX_STATUS = 0x05
+
+TX_OK = 0
+TX_FAIL = 1
+TX_FULL = 2
+
+# RSSI when the radio does not report it
+RSSI_UNKNOWN = -128
+
+# The CRC can be continued over several buffers by passing in the last one
+try:
+	from binascii import crc_hqx
+	def crc16(b, crc=0xFFFF):
+		return crc_hqx(b, crc)
+except ImportError:
+	# MicroPython does not have crc_hqx; four bits at a time
+	_crc_table = (
+		0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50a5, 0x60c6, 0x70e7,
+		0x8108, 0x9129, 0xa14a, 0xb16b, 0xc18c, 0xd1ad, 0xe1ce, 0xf1ef,
+	)
+	def crc16(b, crc=0xFFFF):
+		for x in b:
+			crc = ((crc << 4) & 0xFFFF) ^ _crc_table[(crc >> 12) ^ (x >> 4)]
+			crc = ((crc << 4) & 0xFFFF) ^ _crc_table[(crc >> 12) ^ (x & 0xF)]
+		return crc
+
+# SLIP frame a record of the type with the body
+def encode(kind, body):
+	rec = bytes([kind]) + bytes(body)
+	rec += pack("<H", crc16(rec))
+	rec = rec.replace(b"\xdb", b"\xdb\xdd").replace(b"\xc0", b"\xdb\xdc")
+	return b"\xc0" + rec + b"\xc0"
+
+# A received frame with its timestamp and link quality
+def rx_record(ticks, rssi, lqi, data):
+	return encode(RECORD_RX, pack("<IbBB", ticks, rssi, lqi, len(data)) + bytes(data))
+
+def tx_record(tag, data):
+	return encode(RECORD_TX, bytes([tag]) + bytes(data))
+
+def tx_status_record(tag, status, usec):
+	return encode(RECORD_TX_STATUS, pack("<BBI", tag, status, usec))
+
+# Returns (tag, status, usec) for the body of a RECORD_TX_STATUS
+def tx_status_fields(body):
+	if len(body) != 6:
+		return None
+	return unpack_from("<BBI", body, 0)
+
+# The most that rx_record_into() writes, with every byte escaped
+RX_RECORD_MAX = 2 * (1 + 7 + 127 + 2) + 2
+
+_rx_header = bytearray(8)
+_rx_crc = bytearray(2)
+
+# rx_record() without allocating, for the firmware's receive path.
+# Writes the record into out and returns its length.
+def rx_record_into(out, ticks, rssi, lqi, data):
+	pack_into("<BIbBB", _rx_header, 0, RECORD_RX, ticks, rssi, lqi, len(data))
+	pack_into("<H", _rx_crc, 0, crc16(data, crc16(_rx_header)))
+	out[0] = END
+	j = _escape_into(out, 1, _rx_header)
+	j = _escape_into(out, j, data)
+	j = _escape_into(out, j, _rx_crc)
+	out[j] = END
+	return j + 1
+
+def _escape_into(out, j, b):
+	for x in b:
+		if x == END:
+			out[j] = ESC
+			out[j+1] = ESC_END
+			j += 2
+		elif x == ESC:
+			out[j] = ESC
+			out[j+1] = ESC_ESC
+			j += 2
+		else:
+			out[j] = x
+			j += 1
+	return j
+
+# Returns (ticks, rssi, lqi, data) for the body of a RECORD_RX,
+# or None if the length does not match
+def rx_fields(body):
+	if len(body) < 7:
+		return None
+	(ticks, rssi, lqi, length) = unpack_from("<IbBB", body, 0)
+	if len(body) != 7 + length:
+		return None
+	return (ticks, rssi, lqi, body[7:])
+
+
+# Splits a stream of bytes into the records in it. Bytes before the
+# first END are discarded, so a decoder can start in the middle of
+# a stream, and records that fail the CRC are counted and dropped.
+# The records are unescaped into a preallocated buffer as the bytes
+# arrive, so the firmware can push() them one at a time without
+# allocating.
+class Decoder:
+	def __init__(self, size=512):
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+		self.end = 0
+		self.synced = False
+		self.escaped = False
+		self.kind = 0
+		self.length = 0
+		self.errors = 0
+
+	# Add a byte, returning True if it completes a record, which is
+	# then in kind and body() until the next byte is pushed
+	def push(self, x):
+		if x == END:
+			end = self.end
+			complete = self.synced and end != 0 and self.check(end)
+			self.synced = True
+			self.escaped = False
+			self.end = 0
+			if complete:
+				self.kind = self.buf[0]
+				self.length = end
+			return complete
+
+		if not self.synced:
+			return False
+		if self.escaped:
+			self.escaped = False
+			if x == ESC_END:
+				x = END
+			elif x == ESC_ESC:
+				x = ESC
+		elif x == ESC:
+			self.escaped = True
+			return False
+
+		if self.end == len(self.buf):
+			# lost an END, wait for the next one
+			self.errors += 1
+			self.synced = False
+			return False
+		self.buf[self.end] = x
+		self.end += 1
+		return False
+
+	# The type, body and crc are in buf[0:end]; back to back END
+	# bytes are not an error
+	def check(self, end):
+		buf = self.buf
+		if end < 3 \
+		or crc16(self.view[0:end-2]) != buf[end-2] | buf[end-1] << 8:
+			self.errors += 1
+			return False
+		return True
+
+	def body(self):
+		return self.view[1:self.length-2]
+
+	# Returns a list of (type, body) for the records completed by data
+	def feed(self, data):
+		records = []
+		for x in data:
+			if self.push(x):
+				records.append((self.kind, bytes(self.body())))
+		return records
@@ -10,66 +10,65 @@ COMMAND_JOIN_RESPONSE = 0x02
 COMMAND_DATA_REQUEST = 0x04
 COMMAND_BEACON_REQUEST = 0x07
 
-class IEEE802154:
-	# Construct an IEEE802154 packet either from individual parts
-	# or from a byte stream off the radio passed in as data.
-	def __init__(self,
-		frame_type = 0,
-		src = None,
-		dst = None,
-		src_pan = None,
-		dst_pan = None,
-		seq = 0,
-		command = 0,
-		payload = b'',
-		ack_req = False,
-		data = None
-	):
-		if data is None:
-			self.frame_type = frame_type
-			self.ack_req = ack_req
-			self.src = src
-			self.dst = dst
-			self.src_pan = src_pan
-			self.dst_pan = dst_pan
-			self.seq = seq
-			self.payload = payload
-			self.command = command
-		else:
-			self.deserialize(data)
+from ZbPy import Packet
+from ZbPy.Packet import unpacker
 
-	# parse an incoming 802.15.4 message
-	def deserialize(self,b):
-		j = 0
-		fcf = b[j+0] << 0 | b[j+1] << 8
-		j += 2
+# The header layout for one frame control field value.
+# The field values are indices into the unpacked tuple, with -1 for
+# fields that are not present (the tuple has a None appended), and
+# long addresses are byte offsets into the frame so that they can
+# be sliced without copying from a memoryview.
+class Decoder:
+	__slots__ = (
+		"unpack",
+		"length",
+		"frame_type",
+		"ack_req",
+		"dst_pan",
+		"dst",
+		"dst_long",
+		"src_pan",
+		"src",
+		"src_long",
+		"command",
+	)
+
+	def __init__(self, fcf):
 		self.frame_type = (fcf >> 0) & 0x7
 		self.ack_req = ((fcf >> 5) & 1) != 0
 		dst_mode = (fcf >> 10) & 0x3
 		src_mode = (fcf >> 14) & 0x3
-		self.src = None
-		self.dst = None
-		self.dst_pan = None
-		self.src_pan = None
-		self.command = None
+		self.dst_pan = -1
+		self.dst = -1
+		self.dst_long = None
+		self.src_pan = -1
+		self.src = -1
+		self.src_long = None
+		self.command = -1
 
-		self.seq = b[j]
-		j += 1
+		fmt = "<B" # sequence number
+		fields = 1
+		j = 3
 
 		if dst_mode != 0:
 			# Destination pan is always in the message
-			self.dst_pan = (b[j+0] << 0) | (b[j+1] << 8)
+			fmt += "H"
+			self.dst_pan = fields
+			fields += 1
 			j += 2
 			if dst_mode == 2:
 				# short destination addresses
-				self.dst = b[j+0] << 0 | b[j+1] << 8
+				fmt += "H"
+				self.dst = fields
+				fields += 1
 				j += 2
 			elif dst_mode == 3:
 				# long addresses
-				self.dst = b[j:j+8]
+				fmt += "8x"
+				self.dst_long = j
 				j += 8
 			else:
-				throw("Unknown dst_mode %d" % (dst_mode))
+				raise ValueError("Unknown dst_mode %d" % (dst_mode))
 
 		if src_mode != 0:
 			if (fcf >> 6) & 1:
@@ -77,34 +76,147 @@ class IEEE802154:
 				self.src_pan = self.dst_pan
 			else:
 				# pan is in the message
-				self.src_pan = b[j+0] << 0 | b[j+1] << 8
+				fmt += "H"
+				self.src_pan = fields
+				fields += 1
 				j += 2
 
 			if src_mode == 2:
 				# short source addressing
-				self.src = b[j+0] << 0 | b[j+1] << 8
+				fmt += "H"
+				self.src = fields
+				fields += 1
 				j += 2
 			elif src_mode == 3:
 				# long source addressing
-				self.src = b[j:j+8]
+				fmt += "8x"
+				self.src_long = j
 				j += 8
 			else:
-				throw("Unknown src_mode %d" % (src_mode))
+				raise ValueError("Unknown src_mode %d" % (src_mode))
 
 		if self.frame_type == FRAME_TYPE_CMD:
-			self.command = b[j]
+			fmt += "B"
+			self.command = fields
+			fields += 1
 			j += 1
 
+		self.unpack = unpacker(fmt)
+		self.length = j
+
+# Real traffic only uses a handful of frame control field values,
+# so the address mode decoding is done once per FCF and cached here
+decoders = {}
+
+def decoder(fcf):
+	if fcf not in decoders:
+		decoders[fcf] = Decoder(fcf)
+	return decoders[fcf]
+
+class IEEE802154:
+	# No per-instance __dict__ for the frame classes, since there
+	# is at least one of them for every received packet
+	__slots__ = (
+		"frame_type",
+		"ack_req",
+		"src",
+		"dst",
+		"src_pan",
+		"dst_pan",
+		"seq",
+		"command",
+		"payload",
+	)
+
+	# Construct an IEEE802154 packet either from individual parts
+	# or from a byte stream off the radio passed in as data.
+	def __init__(self,
+		frame_type = 0,
+		src = None,
+		dst = None,
+		src_pan = None,
+		dst_pan = None,
+		seq = 0,
+		command = 0,
+		payload = b'',
+		ack_req = False,
+		data = None
+	):
+		if data is None:
+			self.frame_type = frame_type
+			self.ack_req = ack_req
+			self.src = src
+			self.dst = dst
+			self.src_pan = src_pan
+			self.dst_pan = dst_pan
+			self.seq = seq
+			self.payload = payload
+			self.command = command
+		else:
+			self.deserialize(data)
+
+	# parse an incoming 802.15.4 message
+	# If b is a memoryview, the long addresses and the payload are
+	# views into the receive buffer instead of copies.
+	def deserialize(self,b):
+		d = decoder(b[0] << 0 | b[1] << 8)
+
+		# the whole header in one call, with None for missing fields
+		v = d.unpack(b, 2) + (None,)
+
+		self.frame_type = d.frame_type
+		self.ack_req = d.ack_req
+		self.seq = v[0]
+		self.dst_pan = v[d.dst_pan]
+		self.src_pan = v[d.src_pan]
+		self.command = v[d.command]
+
+		if d.dst_long is None:
+			self.dst = v[d.dst]
+		else:
+			self.dst = b[d.dst_long:d.dst_long+8]
+
+		if d.src_long is None:
+			self.src = v[d.src]
+		else:
+			self.src = b[d.src_long:d.src_long+8]
+
 		# the rest of the message is the payload for the next layer
-		self.payload = b[j:]
+		self.payload = b[d.length:]
 
 		return self
 
 	def serialize(self):
-		hdr = bytearray()
-		hdr.append(0) # FCF will be filled in later
-		hdr.append(0)
-		hdr.append(self.seq & 0x7F)
+		return Packet.serialize(self)
+
+	# The length of the header that serialize_into() writes
+	def header_len(self):
+		j = 3
+		if self.dst_pan is not None:
+			j += 2
+			if type(self.dst) is int:
+				j += 2
+			elif self.dst is not None:
+				j += 8
+		if self.src is not None:
+			if self.src_pan is not None and self.src_pan != self.dst_pan:
+				j += 2
+			if type(self.src) is int:
+				j += 2
+			else:
+				j += 8
+		if self.frame_type == FRAME_TYPE_CMD:
+			j += 1
+		return j
+
+	# Write the header and payload into buf at offset,
+	# returning the offset of the end of the frame
+	def serialize_into(self, buf, offset):
+		Packet.check_room(buf, offset + self.header_len())
+
+		# FCF will be filled in later
+		buf[offset+2] = self.seq & 0x7F
+		j = offset + 3
 
 		fcf = self.frame_type & 0x7
 		if self.ack_req:
@@ -112,55 +224,55 @@ class IEEE802154:
 
 		# Destination address mode
 		if self.dst_pan is not None:
-			hdr.append((self.dst_pan >> 0) & 0xFF)
-			hdr.append((self.dst_pan >> 8) & 0xFF)
+			buf[j+0] = (self.dst_pan >> 0) & 0xFF
+			buf[j+1] = (self.dst_pan >> 8) & 0xFF
+			j += 2
 			if type(self.dst) is int:
 				# short addressing, only 16-bits
 				fcf |= 0x2 << 10
-				hdr.append((self.dst >> 0) & 0xFF)
-				hdr.append((self.dst >> 8) & 0xFF)
+				buf[j+0] = (self.dst >> 0) & 0xFF
+				buf[j+1] = (self.dst >> 8) & 0xFF
+				j += 2
 			elif self.dst is not None:
 				# long address, should be 8 bytes
 				if len(self.dst) != 8:
-					throw("dst address must be 8 bytes")
+					raise ValueError("dst address must be 8 bytes")
 				fcf |= 0x3 << 10
-				hdr.extend(self.dst)
+				buf[j:j+8] = self.dst
+				j += 8
 
 		# Source address mode; can be ommitted entirely
 		if self.src is not None:
 			if self.src_pan is None or self.src_pan == self.dst_pan:
 				fcf |= 1 << 6 # Pan ID compression
 			else:
-				hdr.append((self.src_pan >> 0) & 0xFF)
-				hdr.append((self.src_pan >> 8) & 0xFF)
+				buf[j+0] = (self.src_pan >> 0) & 0xFF
+				buf[j+1] = (self.src_pan >> 8) & 0xFF
+				j += 2
 
 			if type(self.src) is int:
 				# short address, only 16-bits
 				fcf |= 0x2 << 14
-				hdr.append((self.src >> 0) & 0xFF)
-				hdr.append((self.src >> 8) & 0xFF)
+				buf[j+0] = (self.src >> 0) & 0xFF
+				buf[j+1] = (self.src >> 8) & 0xFF
+				j += 2
 			else:
 				# long address, should be 8 bytes
 				if len(self.src) != 8:
-					throw("src address must be 8 bytes")
+					raise ValueError("src address must be 8 bytes")
 				fcf |= 0x3 << 14
-				hdr.extend(self.src)
+				buf[j:j+8] = self.src
+				j += 8
 
 		# add in the frame control field
-		hdr[0] = (fcf >> 0) & 0xFF
-		hdr[1] = (fcf >> 8) & 0xFF
+		buf[offset+0] = (fcf >> 0) & 0xFF
+		buf[offset+1] = (fcf >> 8) & 0xFF
 
 		if self.frame_type == FRAME_TYPE_CMD:
-			hdr.append(self.command)
-
-		if type(self.payload) is memoryview \
-		or type(self.payload) is bytearray \
-		or type(self.payload) is bytes:
-			hdr.extend(self.payload)
-		else:
-			hdr.extend(self.payload.serialize())
+			buf[j] = self.command
+			j += 1
 
-		return hdr
+		return Packet.serialize_payload(self.payload, buf, j)
 
 
 	# parse an IEEE802.15.4 command
@@ -187,6 +299,8 @@ class IEEE802154:
 
 		if type(self.dst) is int:
 			params.append("dst=0x%04x" % (self.dst))
+		elif type(self.dst) is memoryview:
+			params.append("dst=" + str(bytes(self.dst)))
 		elif type(self.dst) is not None:
 			params.append("dst=" + str(self.dst))
 		if type(self.dst_pan) is int:
@@ -194,6 +308,8 @@ class IEEE802154:
 
 		if type(self.src) is int:
 			params.append("src=0x%04x" % (self.src))
+		elif type(self.src) is memoryview:
+			params.append("src=" + str(bytes(self.src)))
 		elif type(self.src) is not None:
 			params.append("src=" + str(self.src))
 		if type(self.src_pan) is int:
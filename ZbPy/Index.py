@@ -0,0 +1,272 @@
+# Sidecar index for pcap captures, so that the frames for an address,
+# cluster or command can be found without decoding the whole capture.
+#
+# build() runs every frame of a capture through Parser.parse() once and
+# writes "capture.pcap.zbidx" next to it. The index has a table with the
+# position, length, link type and timestamp of each frame's data in the
+# capture, and a posting list of frame numbers for each of the keys:
+#
+#	nwk_src=0x1234		NWK short source address
+#	nwk_dst=0xfffd		NWK short destination address
+#	ext_src=0001020304050607	extended source, in frame byte order
+#	cluster=0x0006		APS cluster
+#	profile=0x0104		APS profile
+#	command=OnOff.Toggle	ZCL command name
+#
+# Index.query() intersects the posting lists and Index.frames() reads the
+# matching frames directly out of the memory mapped capture.
+#
+# This is only for the host; it does not run on MicroPython.
+import os
+import sys
+import hashlib
+from array import array
+from binascii import hexlify, unhexlify
+from struct import pack, unpack_from, calcsize
+
+from ZbPy import Pcap
+from ZbPy import Parser
+from ZbPy import KeyRing
+
+MAGIC = b"ZBIX"
+VERSION = 2
+SUFFIX = ".zbidx"
+
+# magic, version, number of frames, number of keys, size and mtime (ns)
+# of the capture, and the digest of the network keys it was decoded with
+HEADER = "<4sIIIQQ16s"
+
+# The digest of a context whose keys are not known, which never matches
+NO_DIGEST = bytes(16)
+
+# The frame table is stored as little endian columns: the offset and
+# length of the data, the link type and the timestamp (NaN if none)
+COLUMNS = (
+	("offsets", "Q"),
+	("lengths", "H"),
+	("linktypes", "H"),
+	("timestamps", "d"),
+)
+
+KEYS = ("nwk_src", "nwk_dst", "ext_src", "cluster", "profile", "command")
+
+
+# The posting list key for a field value
+def key(name, value):
+	if type(value) is int:
+		return "%s=0x%04x" % (name, value)
+	if type(value) is str:
+		return name + "=" + value
+	return name + "=" + hexlify(bytes(value)).decode()
+
+# The keys for a parsed frame
+def frame_keys(ieee, status):
+	keys = []
+	if status == "ieee":
+		return keys
+
+	nwk = ieee.payload
+	keys.append(key("nwk_src", nwk.src))
+	keys.append(key("nwk_dst", nwk.dst))
+	if nwk.ext_src is not None:
+		keys.append(key("ext_src", nwk.ext_src))
+
+	if status in ("aps", "zcl", "zcl?"):
+		aps = nwk.payload
+		keys.append(key("cluster", aps.cluster))
+		keys.append(key("profile", aps.profile))
+
+	if status == "zcl":
+		keys.append(key("command", nwk.payload.payload.payload.name))
+
+	return keys
+
+
+# The digest of the keys in a key ring, so that an index that was built
+# with other keys is rebuilt. Only a KeyRing knows its keys.
+def keys_digest(aes):
+	if aes is None:
+		aes = Parser.keys
+	if type(aes) is not KeyRing.KeyRing:
+		return NO_DIGEST
+	h = hashlib.sha256()
+	for (key, sec_key, sec_key_seq) in sorted(aes.entries):
+		h.update(pack("<BB", sec_key, sec_key_seq) + bytes(key))
+	return h.digest()[0:16]
+
+# Decode every frame in a capture and write its index file.
+# Returns the Index.
+def build(capture, aes=None, filename=None):
+	if filename is None:
+		filename = capture + SUFFIX
+
+	# stat before reading, so a capture that grows while it is
+	# being indexed is seen as changed
+	st = os.stat(capture)
+	parser = Parser.Parser(aes)
+	columns = [array(code) for (name, code) in COLUMNS]
+	(offsets, lengths, linktypes, timestamps) = columns
+	postings = {}
+
+	records = Pcap.read(capture, offsets=True)
+	for (offset, timestamp, linktype, data) in records:
+		number = len(offsets)
+		offsets.append(offset)
+		lengths.append(len(data))
+		linktypes.append(linktype)
+		timestamps.append(timestamp if timestamp is not None else float("nan"))
+
+		if linktype == Pcap.LINKTYPE_IEEE802_15_4_WITHFCS:
+			data = data[0:len(data)-2]
+		elif linktype != Pcap.LINKTYPE_IEEE802_15_4_NOFCS:
+			continue
+
+		# decrypting modifies the frame, so parse a copy of it
+		try:
+			(ieee, status) = parser.parse(bytearray(data))
+			keys = frame_keys(ieee, status)
+		except:
+			continue
+
+		for k in keys:
+			if k not in postings:
+				postings[k] = array("I")
+			postings[k].append(number)
+
+	tmp = filename + ".tmp"
+	with open(tmp, "wb") as f:
+		f.write(pack(HEADER,
+			MAGIC,
+			VERSION,
+			len(offsets),
+			len(postings),
+			st.st_size,
+			st.st_mtime_ns,
+			keys_digest(aes),
+		))
+		for column in columns:
+			f.write(_little(column).tobytes())
+		for (k, numbers) in sorted(postings.items()):
+			name = k.encode()
+			f.write(pack("<HI", len(name), len(numbers)))
+			f.write(name)
+			f.write(_little(numbers).tobytes())
+	os.replace(tmp, filename)
+
+	return Index(capture, filename)
+
+# The arrays are in the native byte order, the file is little endian
+def _little(a):
+	if sys.byteorder != "little":
+		a = array(a.typecode, a)
+		a.byteswap()
+	return a
+
+# Read a little endian array of n items from b at offset j
+def _array(code, b, j, n):
+	a = array(code)
+	a.frombytes(b[j:j+n*a.itemsize])
+	return _little(a)
+
+# Load the index for a capture, building it if it is missing, the capture
+# has changed since it was built, or it was built with different keys.
+# Indexes built with a context other than a KeyRing are always rebuilt.
+def load(capture, aes=None):
+	filename = capture + SUFFIX
+	try:
+		return Index(capture, filename, keys_digest(aes))
+	except (OSError, ValueError):
+		return build(capture, aes, filename)
+
+
+# An index file; if digest is given, it must have been built with those keys
+class Index:
+	def __init__(self, capture, filename=None, digest=None):
+		if filename is None:
+			filename = capture + SUFFIX
+		self.capture = capture
+		self.map = None
+
+		with open(filename, "rb") as f:
+			b = f.read()
+
+		if len(b) < calcsize(HEADER):
+			raise ValueError(filename + ": not a capture index")
+		(magic, version, count, keys, size, mtime, built) = unpack_from(HEADER, b, 0)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError(filename + ": not a capture index")
+		st = os.stat(capture)
+		if size != st.st_size or mtime != st.st_mtime_ns:
+			raise ValueError(filename + ": out of date for " + capture)
+		if digest is not None \
+		and (digest == NO_DIGEST or digest != built):
+			raise ValueError(filename + ": built with other keys")
+
+		j = calcsize(HEADER)
+		for (name, code) in COLUMNS:
+			column = _array(code, b, j, count)
+			setattr(self, name, column)
+			j += count * column.itemsize
+
+		self.postings = {}
+		for i in range(keys):
+			(name_len, n) = unpack_from("<HI", b, j)
+			j += 6
+			name = b[j:j+name_len].decode()
+			j += name_len
+			self.postings[name] = _array("I", b, j, n)
+			j += 4 * n
+
+	def __len__(self):
+		return len(self.offsets)
+
+	# The frame numbers that match all of the given fields, in capture
+	# order, optionally limited to timestamps in [start, end).
+	# ext_src can be bytes in frame order or a hex string.
+	def query(self, start=None, end=None, **fields):
+		matches = None
+		for (name, value) in fields.items():
+			if value is None:
+				continue
+			if name not in KEYS:
+				raise KeyError("Unknown index field " + name)
+			if name == "ext_src" and type(value) is str:
+				value = unhexlify(value)
+			numbers = self.postings.get(key(name, value), ())
+			if matches is None:
+				matches = set(numbers)
+			else:
+				matches &= set(numbers)
+
+		if matches is None:
+			matches = range(len(self))
+
+		results = []
+		for number in sorted(matches):
+			t = self.timestamps[number]
+			if start is not None and not t >= start:
+				continue
+			if end is not None and not t < end:
+				continue
+			results.append(number)
+		return results
+
+	# Generator of (timestamp, linktype, data) for the frame numbers,
+	# with the data as a read-only view into the memory mapped capture
+	def frames(self, numbers):
+		if self.map is None:
+			import mmap
+			with open(self.capture, "rb") as f:
+				self.map = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+		for number in numbers:
+			offset = self.offsets[number]
+			timestamp = self.timestamps[number]
+			if timestamp != timestamp:
+				# NaN is a frame without a timestamp
+				timestamp = None
+			yield (
+				timestamp,
+				self.linktypes[number],
+				self.map[offset:offset+self.lengths[number]],
+			)
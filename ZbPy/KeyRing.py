@@ -0,0 +1,94 @@
+# Zigbee NWK key ring
+# Holds pre-initialized AES contexts for several network keys, indexed
+# by the (sec_key, sec_key_seq) fields of the NWK security header, so
+# that captures with multiple networks or key rotations can be decoded.
+#
+# It also remembers which key last validated for each extended source
+# address, so that the common case costs one CCM* attempt instead of
+# trying every key that might match.
+from binascii import unhexlify
+from ZbPy import AES
+from ZbPy import Cache
+
+# Key identifiers from the security control field
+KEY_DATA = 0
+KEY_NETWORK = 1
+KEY_TRANSPORT = 2
+KEY_LOAD = 3
+
+# Parse a "KEY[:SEQ]" command line argument, a hex network key and the
+# key sequence number that it is used with (default 0), into a tuple of
+# (key, sec_key_seq) for add()
+def parse_key(arg):
+	words = arg.split(":")
+	if len(words) > 2:
+		raise ValueError("key must be KEY[:SEQ]")
+	key = unhexlify(words[0])
+	if len(key) != 16:
+		raise ValueError("key must be 16 bytes")
+	seq = 0
+	if len(words) == 2:
+		seq = int(words[1], 0)
+		if seq < 0 or seq > 255:
+			raise ValueError("key sequence number must be 0 to 255")
+	return (key, seq)
+
+class KeyRing:
+	def __init__(self, keys = None, size = 1024):
+		self.keys = {}
+		self.all = []
+		self.entries = []
+		self.affinity = Cache.LRU(size)
+		if keys is not None:
+			for key in keys:
+				self.add(key)
+
+	def __len__(self):
+		return len(self.all)
+
+	# Add a key and return the AES context for it
+	def add(self, key, sec_key = KEY_NETWORK, sec_key_seq = 0):
+		aes = AES.AES(key)
+		index = (sec_key, sec_key_seq)
+		if index not in self.keys:
+			self.keys[index] = []
+		self.keys[index].append(aes)
+		self.all.append(aes)
+		self.entries.append((key, sec_key, sec_key_seq))
+		return aes
+
+	# A ring with the same keys, but its own AES contexts and affinity,
+	# for use by another thread; the contexts are not thread safe.
+	def copy(self):
+		ring = KeyRing(size=self.affinity.size)
+		for (key, sec_key, sec_key_seq) in self.entries:
+			ring.add(key, sec_key, sec_key_seq)
+		return ring
+
+	# The AES context to use for encrypting with a key
+	def key(self, sec_key = KEY_NETWORK, sec_key_seq = 0):
+		return self.keys[(sec_key, sec_key_seq)][0]
+
+	# The AES contexts to try for a message, starting with the one that
+	# last validated for the source. If no key matches the key sequence
+	# number, then every key in the ring is a candidate.
+	def candidates(self, ext_src, sec_key, sec_key_seq):
+		index = (sec_key, sec_key_seq)
+		if index in self.keys:
+			keys = self.keys[index]
+		else:
+			keys = self.all
+
+		if ext_src is None or len(keys) < 2:
+			return keys
+
+		last = self.affinity.get(bytes(ext_src))
+		if last is None or last is keys[0] or last not in keys:
+			return keys
+
+		return [last] + [aes for aes in keys if aes is not last]
+
+	# Record that a key has validated a message from this source
+	def validated(self, ext_src, aes):
+		if ext_src is not None and len(self.all) > 1:
+			self.affinity.put(bytes(ext_src), aes)
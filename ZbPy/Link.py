@@ -0,0 +1,294 @@
+# Host side of the serial link to a NIC running the NIC.py firmware.
+#
+# The serial port is read in bulk into a reusable buffer, rather than a
+# byte at a time, and split into lines or binary records as they are
+# completed, so that a burst of frames is handed off as one batch.
+#
+# This is only for the host; it does not run on MicroPython.
+import time
+from collections import deque
+from binascii import hexlify, unhexlify
+
+from ZbPy import Framing
+
+class LineReader:
+	def __init__(self, dev, size=4096):
+		self.dev = dev
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+		# the partial line that has been read so far is buf[0:end]
+		self.end = 0
+		# the rest of a line that was too long is discarded
+		self.overflow = False
+		self.overflows = 0
+
+	# Read whatever is available, waiting up to the port's timeout if
+	# nothing is, and return a list of the complete lines without their
+	# line endings. Lines longer than the buffer are discarded.
+	# If a line starts with stop, it is the last one returned and the
+	# data after it is left in buf[0:end].
+	def lines(self, stop=None):
+		dev = self.dev
+		end = self.end
+		n = min(max(dev.in_waiting, 1), len(self.buf) - end)
+		got = dev.readinto(self.view[end:end+n])
+		if not got:
+			return []
+		end += got
+
+		buf = self.buf
+		lines = []
+		start = 0
+		while True:
+			j = buf.find(b"\n", start, end)
+			if j < 0:
+				break
+			k = j
+			if k > start and buf[k-1] == 0x0D:
+				k -= 1
+			if self.overflow:
+				self.overflow = False
+			elif k > start:
+				lines.append(bytes(self.view[start:k]))
+				if stop is not None and lines[-1].startswith(stop):
+					start = j + 1
+					break
+			start = j + 1
+
+		if start == 0 and end == len(buf):
+			# no line ending in the whole buffer
+			if not self.overflow:
+				self.overflows += 1
+			self.overflow = True
+			start = end
+
+		# move the partial line to the front of the buffer
+		remaining = end - start
+		if start != 0 and remaining != 0:
+			buf[0:remaining] = buf[start:end]
+		self.end = remaining
+		return lines
+
+
+# Put a NIC that was left sending binary records back to hex lines,
+# since ^C does not interrupt it while it is in binary mode
+def reset(dev):
+	dev.write(Framing.encode(Framing.RECORD_EXIT, b"") + b"\n")
+	dev.flush()
+
+# The frames received by the NIC, from its hex lines or, if the firmware
+# agrees to it in negotiate(), its binary records. Anything else that
+# the firmware prints is passed to the message function.
+#
+# With binary records the frames to transmit are streamed to the NIC as
+# long as it has room for them, and each one's done function is called
+# with whether it was sent and the seconds from send() until the NIC
+# reported it. Hex lines are written in slow chunks, since there is no
+# flow control for them, and have no reports.
+#
+# A frame whose report has not arrived tx_timeout seconds after it was
+# written, because its record or the report was lost, is given up on by
+# expire(), and its credit is returned. frames() calls it, but if the
+# NIC may be quiet it should also be called every so often.
+class Link:
+	hex_chunk = 32
+	hex_delay = 0.05
+	tx_timeout = 1.0
+
+	def __init__(self, dev, message=None, size=4096):
+		self.dev = dev
+		self.reader = LineReader(dev, size)
+		self.message = message
+		self.decoder = None
+		# frames that arrived while negotiating
+		self.backlog = []
+
+		# for converting the firmware ticks into host time
+		self.period = 0
+		self.epoch = None
+		self.last_ticks = 0
+		self.last_time = 0
+		self.ticks = 0
+
+		# transmit flow control
+		self.credits = 0
+		self.tag = 0
+		self.waiting = deque()
+		self.inflight = {}
+
+	def binary(self):
+		return self.decoder is not None
+
+	# Ask the firmware for binary records, waiting up to timeout seconds
+	# for it to agree. Returns False and stays with hex lines if it does not.
+	def negotiate(self, timeout=1.0):
+		ack = Framing.ACK.encode()
+		# the NIC's line is empty once its loop has started; a blank
+		# line to flush it would be sent to the radio as an empty frame
+		self.dev.write(Framing.HELLO.encode() + b"\n")
+		self.dev.flush()
+
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			for line in self.reader.lines(stop=ack):
+				if not line.startswith(ack):
+					self.hex_line(line, time.time(), self.backlog)
+					continue
+
+				# period and credits; the credits are newer
+				words = line.split()
+				self.period = int(words[2])
+				self.credits = 1
+				if len(words) > 3:
+					self.credits = int(words[3])
+				self.decoder = Framing.Decoder()
+				# everything after the ack is already binary
+				r = self.reader
+				self.binary_records(r.view[0:r.end], self.backlog)
+				r.end = 0
+				return True
+
+		return False
+
+	# Return the link to hex lines
+	def close(self):
+		if self.decoder is not None:
+			self.dev.write(Framing.encode(Framing.RECORD_EXIT, b""))
+			self.dev.flush()
+			self.decoder = None
+
+	# Send a frame for the NIC to transmit. The frame is copied, so the
+	# caller can reuse its buffer.
+	def send(self, data, done=None):
+		if self.decoder is None:
+			s = hexlify(data) + b"\n"
+			for i in range(0, len(s), self.hex_chunk):
+				if i != 0:
+					time.sleep(self.hex_delay)
+				self.dev.write(s[i:i+self.hex_chunk])
+				self.dev.flush()
+			return
+
+		tag = self.tag
+		self.tag = (tag + 1) & 0xFF
+		if tag in self.inflight:
+			# the tag has wrapped around to a frame that was never
+			# reported; a late report would be taken for this one
+			self.give_up(tag, time.time())
+		self.waiting.append((tag, Framing.tx_record(tag, data), time.time(), done))
+		self.pump()
+
+	# Write the waiting frames that the NIC has room for
+	def pump(self):
+		if self.credits == 0 or len(self.waiting) == 0:
+			return
+		records = []
+		now = time.time()
+		while self.credits != 0 and len(self.waiting) != 0:
+			(tag, record, sent, done) = self.waiting.popleft()
+			self.inflight[tag] = (sent, now, done)
+			records.append(record)
+			self.credits -= 1
+		self.dev.write(b"".join(records))
+		self.dev.flush()
+
+	# The NIC has sent a frame, or had no room for it. The reports for
+	# frames that have been given up on have already had their credit.
+	def tx_status(self, tag, status, usec):
+		if tag not in self.inflight:
+			return
+		(sent, written, done) = self.inflight.pop(tag)
+		self.credits += 1
+		if done is not None:
+			done(status == Framing.TX_OK, time.time() - sent)
+		self.pump()
+
+	# Give up on the frames that have gone unreported for too long
+	def expire(self):
+		if len(self.inflight) == 0:
+			return
+		now = time.time()
+		for (tag, (sent, written, done)) in list(self.inflight.items()):
+			if now - written > self.tx_timeout:
+				self.give_up(tag, now)
+		self.pump()
+
+	def give_up(self, tag, now):
+		(sent, written, done) = self.inflight.pop(tag)
+		self.credits += 1
+		if done is not None:
+			done(False, now - sent)
+
+	# Returns True if frames() has something to read without waiting
+	def ready(self):
+		return len(self.backlog) != 0 or self.dev.in_waiting != 0
+
+	# Read whatever is available, waiting up to the port's timeout if
+	# nothing is, and return a list of (timestamp, rssi, lqi, data) for
+	# the frames. The timestamps are in host time.time() seconds; hex
+	# lines are stamped when they are read and have no rssi or lqi.
+	def frames(self):
+		frames = self.backlog
+		self.backlog = []
+		self.expire()
+
+		if self.decoder is None:
+			lines = self.reader.lines()
+			now = time.time()
+			for line in lines:
+				self.hex_line(line, now, frames)
+			return frames
+
+		dev = self.dev
+		data = dev.read(max(dev.in_waiting, 1))
+		self.binary_records(data, frames)
+		return frames
+
+	def hex_line(self, line, now, frames):
+		try:
+			frames.append((now, None, None, unhexlify(line)))
+		except:
+			self.text(line)
+
+	def binary_records(self, data, frames):
+		for (kind, body) in self.decoder.feed(data):
+			if kind == Framing.RECORD_RX:
+				rx = Framing.rx_fields(body)
+				if rx is None:
+					self.decoder.errors += 1
+					continue
+				(ticks, rssi, lqi, frame) = rx
+				if rssi == Framing.RSSI_UNKNOWN:
+					rssi = None
+				frames.append((self.timestamp(ticks), rssi, lqi, frame))
+			elif kind == Framing.RECORD_TEXT:
+				self.text(body)
+			elif kind == Framing.RECORD_TX_STATUS:
+				status = Framing.tx_status_fields(body)
+				if status is not None:
+					self.tx_status(*status)
+
+	def text(self, line):
+		if self.message is not None:
+			self.message(line.decode("utf-8", "replace"))
+
+	# Convert the firmware's wrapping microsecond ticks into host time,
+	# lined up with the host clock when the first record arrives.
+	# The ticks only give the time between records modulo the period
+	# (2^30 usec, about 18 minutes, on MicroPython), so the host clock
+	# is used to add back the whole periods when the channel has been
+	# quiet for longer than that.
+	def timestamp(self, ticks):
+		now = time.time()
+		if self.epoch is None:
+			self.epoch = now
+		else:
+			delta = (ticks - self.last_ticks) % self.period
+			elapsed = (now - self.last_time) * 1e6
+			periods = int((elapsed - delta) / self.period + 0.5)
+			if periods > 0:
+				delta += periods * self.period
+			self.ticks += delta
+		self.last_ticks = ticks
+		self.last_time = now
+		return self.epoch + self.ticks * 1e-6
@@ -1,69 +1,352 @@
 # Zigbee/IEEE 802.15.4 serial NIC device
 #
+# Received frames are sent to the host as hex lines, or as binary records
+# with their timestamp and link quality once the host has asked for them
+# (see Framing.py), and frames from the host are transmitted.
 #
+# In binary mode the frames from the host are queued and the host is
+# told when each one has been sent, which gives it back the credit for
+# the queue slot that the frame used (see Framing.py).
+#
+# The receive path does not allocate: the radio is drained into a ring
+# of preallocated frame buffers, only the frame control field is decoded
+# to find the join responses and beacons, and the output is built in a
+# preallocated buffer. Garbage collection is left until the radio has been
+# idle for a while, or the free heap drops below a watermark, instead of
+# running after every frame.
+#
+# The hardware modules are only imported by loop(), which passes them to
+# the Link and NIC, so the module can be imported and driven off the
+# board with a simulated radio and stdio.
 
 import gc
-import os
 import sys
-import machine
-import Radio
 from ZbPy import IEEE802154
-from binascii import unhexlify, hexlify
-from struct import unpack
+from ZbPy import Framing
+from ZbPy import Packet
+from binascii import unhexlify
+from struct import unpack_from
 
-Radio.init()
+try:
+	from time import ticks_us, ticks_add, ticks_diff
+except:
+	import time
+	def ticks_us():
+		return int(time.time() * 1e6) & 0x3FFFFFFF
+	def ticks_add(a, b):
+		return (a + b) & 0x3FFFFFFF
+	def ticks_diff(a, b):
+		return ((a - b + 0x20000000) & 0x3FFFFFFF) - 0x20000000
 
-def loop():
-	pan_set = False
+# Only MicroPython reports the free heap
+def mem_free():
+	if hasattr(gc, "mem_free"):
+		return gc.mem_free()
+	return -1
 
-	incoming = ''
-	machine.zrepl(False)
+_hex_digits = b"0123456789abcdef"
 
-	while True:
-		pkt = Radio.rx()
-		if pkt is not None:
-			# throw away the extra b' and ' on the string
-			# representation
-			x = repr(hexlify(pkt))[2:-1]
-			print(x)
-
-			ieee = IEEE802154.IEEE802154(data=pkt)
-
-			if ieee.frame_type == IEEE802154.FRAME_TYPE_CMD \
-			and ieee.command == IEEE802154.COMMAND_JOIN_RESPONSE:
-				# reponse to our join request; update our short address
-				(new_nwk, status) = unpack("<HB", ieee.payload)
-				if status == 0:
-					print("NIC: NEW NWK %04x" % (new_nwk))
-					Radio.address(new_nwk)
-				else:
-                                	print("NIC: NEW NWK failed")
-
-			elif ieee.frame_type == IEEE802154.FRAME_TYPE_BEACON \
-			and not pan_set \
-			and ieee.payload[1] & 0x80 \
-			and ieee.src != 0x0000:
-				print("NIC: NEW PAN %04x" % (ieee.src_pan))                        
-				Radio.pan(ieee.src_pan)
-				pan_set = True
-
-			x = None
-			gc.collect()
+# Write data into out as a line of hex, returning the length
+def hex_into(out, data):
+	j = 0
+	for x in data:
+		out[j+0] = _hex_digits[x >> 4]
+		out[j+1] = _hex_digits[x & 0xF]
+		j += 2
+	out[j] = 0x0A
+	return j + 1
+
+# Room in the transmit queue for frames from the host
+TX_CREDITS = 4
+
+# The host side of stdio. stdio_poll() returns True if there is input
+# from the host, and kbd_intr() sets the character that interrupts.
+class Link:
+	def __init__(self, radio, stdio_poll, kbd_intr=None, credits=TX_CREDITS):
+		self.radio = radio
+		self.stdio_poll = stdio_poll
+		self.kbd_intr = kbd_intr
+		self.binary = False
+		self.incoming = ''
+		self.decoder = None
+		self.out = getattr(sys.stdout, "buffer", sys.stdout)
+		self.inp = getattr(sys.stdin, "buffer", sys.stdin)
+		self.inbuf = bytearray(1)
+		self.outbuf = bytearray(Framing.RX_RECORD_MAX)
+		self.outview = memoryview(self.outbuf)
+		self.txq = Ring(credits)
+
+	# The radio driver may not report the link quality
+	def rssi(self):
+		if hasattr(self.radio, "rssi"):
+			return self.radio.rssi()
+		return Framing.RSSI_UNKNOWN
+
+	def lqi(self):
+		if hasattr(self.radio, "lqi"):
+			return self.radio.lqi()
+		return 0
+
+	def ready(self):
+		return self.stdio_poll()
+
+	# Status messages go out as text lines or TEXT records
+	def message(self, s):
+		if self.binary:
+			self.out.write(Framing.encode(Framing.RECORD_TEXT, s.encode()))
+		else:
+			print(s)
+
+	def rx(self, pkt, ticks):
+		if self.binary:
+			n = Framing.rx_record_into(self.outbuf, ticks, self.rssi(), self.lqi(), pkt)
+		else:
+			n = hex_into(self.outbuf, pkt)
+		self.out.write(self.outview[0:n])
+
+	def start_binary(self):
+		# tell the host how often the timestamps wrap,
+		# and how many frames it can queue
+		print(Framing.ACK, ticks_add(0, -1) + 1, len(self.txq.bufs))
+		self.binary = True
+		self.decoder = Framing.Decoder()
+		# ^C is a valid byte in a record
+		if self.kbd_intr is not None:
+			self.kbd_intr(-1)
+
+	def stop_binary(self):
+		self.binary = False
+		self.decoder = None
+		if self.kbd_intr is not None:
+			self.kbd_intr(3)
+
+	def tx(self, x):
+		try:
+			self.radio.tx(x)
+		except:
+			self.message("TX FAIL")
+			return False
+		return True
+
+	# Queue a frame from the host, or tell it that there was no room
+	def queue(self, body):
+		if len(body) < 1:
+			return
+		tag = body[0]
+		if not self.txq.put(body[1:], ticks_us(), tag):
+			self.out.write(Framing.tx_status_record(tag, Framing.TX_FULL, 0))
+
+	# Send the oldest queued frame, returning False if there are none
+	def transmit(self):
+		txq = self.txq
+		i = txq.oldest()
+		if i < 0:
+			return False
+		if self.tx(txq.frame(i)):
+			status = Framing.TX_OK
+		else:
+			status = Framing.TX_FAIL
+		usec = ticks_diff(ticks_us(), txq.ticks[i])
+		tag = txq.tags[i]
+		txq.done()
+		self.out.write(Framing.tx_status_record(tag, status, usec))
+		return True
+
+	# Process the bytes from the host
+	def poll(self):
+		if self.binary:
+			# a record at a time, rather than a byte per loop,
+			# read into a preallocated buffer and decoder
+			decoder = self.decoder
+			inbuf = self.inbuf
+			for n in range(Framing.RX_RECORD_MAX):
+				if self.inp.readinto(inbuf) == 1 and decoder.push(inbuf[0]):
+					if decoder.kind == Framing.RECORD_TX:
+						self.queue(decoder.body())
+					elif decoder.kind == Framing.RECORD_EXIT:
+						self.stop_binary()
+						return
+				if not self.stdio_poll():
+					break
+			return
+
+		y = sys.stdin.read(1)
+		if y == '\r':
+			return
+		if y != '\n':
+			self.incoming += y
+			return
+		#print("SEND:", incoming)
+		incoming = self.incoming
+		self.incoming = ''
+		if len(incoming) == 0:
+			return
+		if incoming == Framing.HELLO:
+			self.start_binary()
+			return
+		try:
+			x = unhexlify(incoming)
+		except:
+			print("TX FAIL")
+			return
+		self.tx(x)
 
-		if machine.stdio_poll():
-			y = sys.stdin.read(1)
-			if y == '\r':
-				continue
-			if y != '\n':
-				incoming += y
-				continue
-			#print("SEND:", incoming)
-			try:
-				x = unhexlify(incoming)
-				Radio.tx(x)
-			except:
-				print("TX FAIL")
-			incoming = ''
-			x = None
+
+# Received frames waiting to be sent to the host, in preallocated buffers.
+# Frames that arrive while the ring is full are counted and dropped.
+class Ring:
+	def __init__(self, count=8):
+		self.bufs = [bytearray(Packet.MAX_FRAME) for i in range(count)]
+		self.views = [memoryview(buf) for buf in self.bufs]
+		self.lens = [0] * count
+		self.ticks = [0] * count
+		self.tags = [0] * count
+		self.head = 0
+		self.count = 0
+		self.dropped = 0
+
+	# Copy a frame into the next free buffer
+	def put(self, pkt, ticks, tag=0):
+		size = len(self.bufs)
+		n = len(pkt)
+		if self.count == size or n > Packet.MAX_FRAME:
+			self.dropped += 1
+			return False
+		i = self.head + self.count
+		if i >= size:
+			i -= size
+		self.views[i][0:n] = pkt
+		self.lens[i] = n
+		self.ticks[i] = ticks
+		self.tags[i] = tag
+		self.count += 1
+		return True
+
+	# The index of the oldest frame, or -1 if the ring is empty.
+	# It is removed by done() once it has been handled.
+	def oldest(self):
+		if self.count == 0:
+			return -1
+		return self.head
+
+	def done(self):
+		self.head += 1
+		if self.head == len(self.bufs):
+			self.head = 0
+		self.count -= 1
+
+	def frame(self, i):
+		return self.views[i][0:self.lens[i]]
+
+
+class NIC:
+	def __init__(self, link, radio, ring_size=8, idle_us=20000, watermark=4096):
+		self.link = link
+		self.radio = radio
+		self.ring = Ring(ring_size)
+		self.pan_set = False
+		# collect when idle for this long, or when the heap is this low
+		self.idle_us = idle_us
+		self.watermark = watermark
+		self.last_active = ticks_us()
+		self.dirty = False
+
+	# Pull every frame that the radio has into the ring
+	def drain(self):
+		ring = self.ring
+		while ring.count < len(ring.bufs):
+			pkt = self.radio.rx()
+			if pkt is None:
+				return
+			ring.put(pkt, ticks_us())
+
+	# Send the frames in the ring to the host, handling the ones for us.
+	# At most a ring's worth are sent before returning to check the host.
+	def process(self):
+		ring = self.ring
+		for n in range(len(ring.bufs)):
+			i = ring.oldest()
+			if i < 0:
+				return
+			self.link.rx(ring.frame(i), ring.ticks[i])
+			self.handle(ring.bufs[i], ring.lens[i])
+			ring.done()
+			self.active()
+			# keep the radio drained between frames
+			self.drain()
+
+	# Only the frame control field is decoded for most frames
+	def handle(self, b, n):
+		if n < 3:
+			return
+		frame_type = b[0] & 0x7
+		if frame_type != IEEE802154.FRAME_TYPE_CMD \
+		and (frame_type != IEEE802154.FRAME_TYPE_BEACON or self.pan_set):
+			return
+
+		try:
+			d = IEEE802154.decoder((b[1] << 8) | (b[0] << 0))
+		except ValueError:
+			return
+		j = d.length
+
+		if frame_type == IEEE802154.FRAME_TYPE_CMD:
+			# the command is the last byte of the header
+			if n < j + 3 or b[j-1] != IEEE802154.COMMAND_JOIN_RESPONSE:
+				return
+			# reponse to our join request; update our short address
+			(new_nwk, status) = unpack_from("<HB", b, j)
+			if status == 0:
+				self.link.message("NIC: NEW NWK %04x" % (new_nwk))
+				self.radio.address(new_nwk)
+			else:
+				self.link.message("NIC: NEW NWK failed")
+			return
+
+		# beacon from a coordinator that is accepting joins
+		if n < j + 2 or not b[j+1] & 0x80:
+			return
+		if d.src_pan < 0:
+			return
+		fields = d.unpack(b, 2)
+		if d.src >= 0 and fields[d.src] == 0x0000:
+			return
+		src_pan = fields[d.src_pan]
+		self.link.message("NIC: NEW PAN %04x" % (src_pan))
+		self.radio.pan(src_pan)
+		self.pan_set = True
+
+	def active(self):
+		self.last_active = ticks_us()
+		self.dirty = True
+
+	# Collect garbage once the radio has gone quiet, or right away
+	# if the heap is running low
+	def collect(self):
+		if not self.dirty:
+			return
+		if ticks_diff(ticks_us(), self.last_active) >= self.idle_us \
+		or 0 <= mem_free() < self.watermark:
 			gc.collect()
+			self.dirty = False
 
+	def poll(self):
+		self.drain()
+		self.process()
+		if self.link.ready():
+			self.link.poll()
+			self.active()
+		if self.link.transmit():
+			self.active()
+		self.collect()
+
+def loop():
+	import machine
+	import micropython
+	import Radio
+	Radio.init()
+	nic = NIC(Link(Radio, machine.stdio_poll, micropython.kbd_intr), Radio)
+	machine.zrepl(False)
+
+	while True:
+		nic.poll()
@@ -35,3 +35,43 @@ class Packet:
 		self._offset += len
 		return x
 
+
+# Returns a function(buffer, offset) that unpacks a fixed format,
+# precompiled where the struct module supports it (MicroPython does not)
+try:
+	from struct import Struct
+	def unpacker(fmt):
+		return Struct(fmt).unpack_from
+except ImportError:
+	from struct import unpack_from
+	def unpacker(fmt):
+		return lambda b, offset: unpack_from(fmt, b, offset)
+
+
+# The largest IEEE 802.15.4 PHY payload; all of the layers
+# of a frame have to fit into a buffer of this size.
+MAX_FRAME = 127
+
+# Raise an error if a layer ending at end does not fit in buf;
+# assigning to a slice past the end would quietly grow the buffer
+def check_room(buf, end):
+	if end > len(buf):
+		raise ValueError("frame too long")
+
+# Write a payload that is either raw bytes or another layer
+# into buf at offset, returning the offset of the end of it
+def serialize_payload(payload, buf, offset):
+	if type(payload) is memoryview \
+	or type(payload) is bytearray \
+	or type(payload) is bytes:
+		end = offset + len(payload)
+		check_room(buf, end)
+		buf[offset:end] = payload
+		return end
+	return payload.serialize_into(buf, offset)
+
+# Serialize a layer into a new bytearray
+def serialize(layer):
+	buf = bytearray(MAX_FRAME)
+	end = layer.serialize_into(buf, 0)
+	return buf[0:end]
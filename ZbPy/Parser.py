@@ -3,12 +3,16 @@
 #
 from binascii import unhexlify, hexlify
 
-from ZbPy import AES
+from ZbPy import KeyRing
+from ZbPy import Cache
+from ZbPy import Pool
 from ZbPy import IEEE802154
 from ZbPy import ZigbeeNetwork
 from ZbPy import ZigbeeApplication
 from ZbPy import ZigbeeCluster
 from ZbPy import ZCL
+from ZbPy import Filter
+from ZbPy import Replay
 
 import gc
 gc.collect()
@@ -16,66 +20,279 @@ gc.collect()
 # This is the "well known" zigbee2mqtt key.
 # The Ikea gateway uses a different key that has to be learned
 # by joining the network (not yet implemented)
+# Other network keys can be added to the key ring.
 nwk_key = unhexlify(b"01030507090b0d0f00020406080a0c0d")
-aes = AES.AES(nwk_key)
+keys = KeyRing.KeyRing()
+aes = keys.add(nwk_key)
 
-# Pre-allocate message types for the parser
-# Only one message can be parsed at a time
-ieee = IEEE802154.IEEE802154()
-nwk = ZigbeeNetwork.ZigbeeNetwork(aes=aes)
-aps = ZigbeeApplication.ZigbeeApplication()
-zcl = ZigbeeCluster.ZigbeeCluster()
-cmd = ZCL.ZCL()
+# A parser owns a set of pre-allocated message types and the state
+# for filtering dupes. Only one message can be parsed at a time by
+# each parser, and the layers it returns are reused by the next call,
+# so threads decoding separate streams each need their own parser.
+class Parser:
+	def __init__(self, aes=None, cache=None, replay=None):
+		if aes is None:
+			aes = keys
+		if replay is None:
+			replay = Replay.Replay()
+		self.aes = aes
+		self.cache = cache
+		self.replay = replay
+		self.ieee = IEEE802154.IEEE802154()
+		self.nwk = ZigbeeNetwork.ZigbeeNetwork(aes=aes)
+		self.aps = ZigbeeApplication.ZigbeeApplication()
+		self.zcl = ZigbeeCluster.ZigbeeCluster()
+		self.cmd = ZCL.ZCL()
 
-# For filtering dupes
-seqs = {}
+	# Drop the references to the last message
+	def clear(self):
+		self.ieee.payload = None
+		self.nwk.payload = None
+		self.nwk.ccm = None
+		self.aps.payload = None
+		self.zcl.payload = None
 
-def parse(data, verbose=False, filter_dupes=False):
-	global seqs
+	# Parse a raw IEEE802.15.4 frame into the pre-allocated layer objects,
+	# returning the IEEE layer and a string of how far the parsing went.
+	#
+	# If an LRU cache is passed in (or the parser has one), decoded NWK
+	# layer trees are cached by the raw NWK bytes so that rebroadcasts and
+	# retransmits of a frame skip the CCM* work. Cached trees are shared
+	# and must not be modified.
+	#
+	# Passing a memoryview of a bytearray decodes without copying: every
+	# layer refers to the receive buffer and decryption is done in place,
+	# so the buffer must not be reused while the layers are in use.
+	#
+	# If a Filter is passed in, frames that it rules out from their raw
+	# MAC and NWK headers return None, "filtered" without being decrypted
+	# or decoded, and decoded frames that do not match have the status
+	# "filtered".
+	def parse(self, data, verbose=False, filter_dupes=False, cache=None, filter=None):
+		if filter is None:
+			return self.decode(data, verbose, filter_dupes, cache)
 
-	#print("------")
-	#print(data)
-	ieee.deserialize(data)
+		fields = filter.early(data)
+		if fields is None:
+			return None, "filtered"
 
-	if verbose: print(ieee)
+		(ieee, status) = self.decode(data, verbose, filter_dupes, cache)
+		if not filter.late(fields, ieee):
+			return ieee, "filtered"
+		return ieee, status
 
-	if ieee.frame_type != IEEE802154.FRAME_TYPE_DATA:
-		return ieee, "ieee"
-	if len(ieee.payload) == 0:
-		return ieee, "ieee"
+	def decode(self, data, verbose=False, filter_dupes=False, cache=None):
+		if cache is None:
+			cache = self.cache
 
-	nwk.deserialize(ieee.payload)
-	ieee.payload = nwk
-	if verbose: print(nwk)
+		ieee = self.ieee
+		ieee.deserialize(data)
 
-	if nwk.frame_type != ZigbeeNetwork.FRAME_TYPE_DATA:
-		return ieee, "nwk"
+		if verbose: print(ieee)
 
-	if filter_dupes:
-		if nwk.src in seqs and seqs[nwk.src] == nwk.seq:
-			return ieee, "dupe"
-	seqs[nwk.src] = nwk.seq
+		if ieee.frame_type != IEEE802154.FRAME_TYPE_DATA:
+			return ieee, "ieee"
+		if len(ieee.payload) == 0:
+			return ieee, "ieee"
 
-	aps.deserialize(nwk.payload)
-	nwk.payload = aps
+		if cache is None:
+			(ieee.payload, status) = self.parse_nwk(ieee.payload,
+				self.nwk, self.aps, self.zcl, self.cmd,
+				verbose, filter_dupes)
+			return ieee, status
 
-	if verbose: print(aps)
+		# the key must be taken before decryption modifies the payload
+		key = bytes(ieee.payload)
+		hit = cache.get(key)
+		if hit is None:
+			# decode into new layer objects, since they outlive this call,
+			# and a copy of the data rather than the receive buffer
+			hit = self.parse_nwk(bytearray(key),
+				ZigbeeNetwork.ZigbeeNetwork(aes=self.aes),
+				ZigbeeApplication.ZigbeeApplication(),
+				ZigbeeCluster.ZigbeeCluster(),
+				ZCL.ZCL(),
+				verbose, filter_dupes)
+			if hit[1] != "dupe":
+				cache.put(key, hit)
+		elif hit[1] != "nwk" and self.is_dupe(hit[0], filter_dupes):
+			hit = (hit[0], "dupe")
 
-	if aps.frame_type != ZigbeeApplication.FRAME_TYPE_DATA \
-	or aps.profile != ZigbeeApplication.PROFILE_HOME:
-		return ieee, "aps"
+		ieee.payload = hit[0]
+		return ieee, hit[1]
 
-	zcl.deserialize(aps.payload)
-	aps.payload = zcl
+	# Track the sequence numbers and frame counters from each NWK source
+	def is_dupe(self, nwk, filter_dupes):
+		return self.replay.nwk(nwk) and filter_dupes
 
-	if verbose: print(zcl)
+	# Parse the NWK layer and everything above it into the layer objects,
+	# returning the NWK layer and how far the parsing went.
+	def parse_nwk(self, data, nwk, aps, zcl, cmd, verbose=False, filter_dupes=False):
+		nwk.deserialize(data)
+		if verbose: print(nwk)
 
-	cmd.cluster = aps.cluster
-	cmd.command = zcl.command
-	if not cmd.deserialize(zcl.payload):
-		return ieee, "zcl?"
+		if nwk.frame_type != ZigbeeNetwork.FRAME_TYPE_DATA:
+			return nwk, "nwk"
 
-	# Successfully decoded all the way to the ZCL layer
-	zcl.payload = cmd
+		if self.is_dupe(nwk, filter_dupes):
+			return nwk, "dupe"
 
-	return ieee, "zcl"
+		aps.deserialize(nwk.payload)
+		nwk.payload = aps
+
+		if verbose: print(aps)
+
+		if aps.frame_type != ZigbeeApplication.FRAME_TYPE_DATA \
+		or aps.profile != ZigbeeApplication.PROFILE_HOME:
+			return nwk, "aps"
+
+		zcl.deserialize(aps.payload)
+		aps.payload = zcl
+
+		if verbose: print(zcl)
+
+		cmd.cluster = aps.cluster
+		cmd.command = zcl.command
+		if not cmd.deserialize(zcl.payload):
+			return nwk, "zcl?"
+
+		# Successfully decoded all the way to the ZCL layer
+		zcl.payload = cmd
+
+		return nwk, "zcl"
+
+
+# The default parser used by parse(); its layer objects and dupe
+# filter are also available as module variables.
+parser = Parser(keys)
+ieee = parser.ieee
+nwk = parser.nwk
+aps = parser.aps
+zcl = parser.zcl
+cmd = parser.cmd
+replay = parser.replay
+
+def parse(data, verbose=False, filter_dupes=False, cache=None, filter=None):
+	return parser.parse(data, verbose, filter_dupes, cache, filter)
+
+
+# Parsers for worker threads, each with its own copy of the key ring
+# since the AES contexts keep chaining state between calls. The aes can
+# be a KeyRing or a single AES context; either has a copy() for this,
+# and anything else is rejected. A thread should hold its lease for a
+# whole stream so that the dupe filter sees all of the stream's messages:
+#	pool = Parser.ParserPool()
+#	with pool.lease() as parser:
+#		for data in stream:
+#			ieee, status = parser.parse(data, filter_dupes=True)
+class ParserPool(Pool.SharedPool):
+	def __init__(self, aes=None, size=4, cache_size=0):
+		Pool.SharedPool.__init__(self, Parser, size)
+		if aes is None:
+			aes = keys
+		if not hasattr(aes, "copy"):
+			raise ValueError("ParserPool needs a KeyRing or AES context")
+		self.aes = aes
+		self.cache_size = cache_size
+
+	def create(self):
+		cache = None
+		if self.cache_size:
+			cache = Cache.LRU(self.cache_size)
+		return Parser(self.aes.copy(), cache)
+
+	def reset(self, parser):
+		parser.clear()
+
+
+# A frame that is only decoded as far as the caller looks into it.
+# The ieee, nwk, aps, zcl and command layers are decoded on first access
+# and memoized, and are None if the frame does not have that layer.
+# The NWK header is decoded without decrypting the payload; the CCM*
+# work is only done when aps (or a layer above it) is accessed, so tools
+# that filter on the MAC or NWK addresses skip it for discarded frames.
+#
+# Like parse(), the layers are linked through their payloads as they
+# are decoded, and a memoryview can be passed in for zero-copy decoding.
+class Frame:
+	__slots__ = (
+		"data",
+		"aes",
+		"_ieee",
+		"_nwk",
+		"_aps",
+		"_zcl",
+		"_command",
+	)
+
+	def __init__(self, data, aes=None):
+		if aes is None:
+			aes = keys
+		self.data = data
+		self.aes = aes
+		# None is not yet decoded, False is not present
+		self._ieee = None
+		self._nwk = None
+		self._aps = None
+		self._zcl = None
+		self._command = None
+
+	def __str__(self):
+		return str(self.ieee)
+
+	@property
+	def ieee(self):
+		if self._ieee is None:
+			self._ieee = IEEE802154.IEEE802154(data=self.data)
+		return self._ieee
+
+	@property
+	def nwk(self):
+		if self._nwk is None:
+			ieee = self.ieee
+			if ieee.frame_type != IEEE802154.FRAME_TYPE_DATA \
+			or len(ieee.payload) == 0:
+				self._nwk = False
+			else:
+				self._nwk = ZigbeeNetwork.ZigbeeNetwork(aes=self.aes)
+				self._nwk.deserialize(ieee.payload, decrypt=False)
+				ieee.payload = self._nwk
+		return self._nwk or None
+
+	@property
+	def aps(self):
+		if self._aps is None:
+			nwk = self.nwk
+			if nwk is None \
+			or nwk.frame_type != ZigbeeNetwork.FRAME_TYPE_DATA:
+				self._aps = False
+			else:
+				nwk.decrypt()
+				self._aps = ZigbeeApplication.ZigbeeApplication(data=nwk.payload)
+				nwk.payload = self._aps
+		return self._aps or None
+
+	@property
+	def zcl(self):
+		if self._zcl is None:
+			aps = self.aps
+			if aps is None \
+			or aps.frame_type != ZigbeeApplication.FRAME_TYPE_DATA \
+			or aps.profile != ZigbeeApplication.PROFILE_HOME:
+				self._zcl = False
+			else:
+				self._zcl = ZigbeeCluster.ZigbeeCluster(data=aps.payload)
+				aps.payload = self._zcl
+		return self._zcl or None
+
+	@property
+	def command(self):
+		if self._command is None:
+			zcl = self.zcl
+			self._command = False
+			if zcl is not None:
+				cmd = ZCL.ZCL(cluster=self.aps.cluster, command=zcl.command)
+				if cmd.deserialize(zcl.payload):
+					self._command = cmd
+					zcl.payload = cmd
+		return self._command or None
@@ -0,0 +1,318 @@
+# Read and write pcap and pcapng capture files of IEEE 802.15.4 frames
+# https://wiki.wireshark.org/Development/LibpcapFileFormat
+# https://www.ietf.org/archive/id/draft-tuexen-opsawg-pcapng-05.html
+#
+# The readers are generators of (timestamp, linktype, data) tuples,
+# or (offset, timestamp, linktype, data) if offsets are requested, where
+# offset is the position of the data in the file.
+# read() memory maps the file and the data is a read-only memoryview
+# into the map, so large captures are never copied into memory; the
+# decoders modify frames in place while decrypting, so copy the data
+# into a bytearray before decoding it.
+#
+# This is only for the host; it does not run on MicroPython.
+from struct import pack, unpack, unpack_from
+import time
+
+LINKTYPE_IEEE802_15_4_WITHFCS = 195
+LINKTYPE_IEEE802_15_4_NOFCS = 230
+
+# pcap magic numbers for microsecond and nanosecond timestamps
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+
+# pcapng blocks
+BLOCK_SHB = 0x0A0D0D0A
+BLOCK_IDB = 0x00000001
+BLOCK_SPB = 0x00000003
+BLOCK_EPB = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+OPTION_END = 0
+OPTION_IF_TSRESOL = 9
+
+
+# Memory map a pcap or pcapng file and return a generator of its records
+def read(filename, offsets=False):
+	import mmap
+	with open(filename, "rb") as f:
+		try:
+			m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			# empty files can not be mapped
+			return iter(())
+
+	if hasattr(m, "madvise"):
+		m.madvise(mmap.MADV_SEQUENTIAL)
+
+	# the views into the map keep it open after the file is closed
+	return records(_mapped(memoryview(m)), offsets)
+
+# Read a pcap or pcapng stream, such as a pipe from zbsniff,
+# returning a generator of its records
+def read_stream(f, offsets=False):
+	return records(f.read, offsets)
+
+# Returns a fetch function that returns successive views into buf
+def _mapped(buf):
+	offset = [0]
+	def fetch(n):
+		start = offset[0]
+		offset[0] = start + n
+		return buf[start:start+n]
+	return fetch
+
+# Parse the records from a fetch(n) function that returns the next
+# n bytes of the file, or fewer at the end of it.
+def records(fetch, offsets=False):
+	# count the bytes that have been read to know where the data is
+	position = [0]
+	def counted(n):
+		b = fetch(n)
+		position[0] += len(b)
+		return b
+
+	if not offsets:
+		counted = fetch
+		position = None
+
+	magic = counted(4)
+	if len(magic) < 4:
+		return iter(())
+
+	if unpack("<I", magic)[0] == BLOCK_SHB:
+		return _pcapng(counted, position)
+
+	for endian in ("<", ">"):
+		(value,) = unpack(endian + "I", magic)
+		if value == PCAP_MAGIC:
+			return _pcap(counted, position, endian, 1e-6)
+		if value == PCAP_MAGIC_NSEC:
+			return _pcap(counted, position, endian, 1e-9)
+
+	raise ValueError("not a pcap or pcapng file")
+
+def _pcap(fetch, position, endian, scale):
+	hdr = fetch(20)
+	if len(hdr) < 20:
+		return
+	# the upper bits of the link type have the FCS length
+	linktype = unpack_from(endian + "I", hdr, 16)[0] & 0xFFFF
+
+	rec_fmt = endian + "IIII"
+	while True:
+		rec = fetch(16)
+		if len(rec) < 16:
+			return
+		(sec, frac, incl_len, orig_len) = unpack(rec_fmt, rec)
+		data = fetch(incl_len)
+		if len(data) < incl_len:
+			# truncated capture
+			return
+		if position is None:
+			yield (sec + frac * scale, linktype, data)
+		else:
+			yield (position[0] - incl_len, sec + frac * scale, linktype, data)
+
+def _pcapng(fetch, position):
+	# the block type of the section header was read by records()
+	block_type = BLOCK_SHB
+	endian = "<"
+	interfaces = []
+
+	while True:
+		if block_type == BLOCK_SHB:
+			# the byte order magic determines how to read the length
+			hdr = fetch(8)
+			if len(hdr) < 8:
+				return
+			endian = "<"
+			if unpack("<I", hdr[4:8])[0] != BYTE_ORDER_MAGIC:
+				endian = ">"
+			length = unpack_from(endian + "I", hdr, 0)[0]
+			# each section has its own interfaces
+			interfaces = []
+			body = fetch(length - 12)
+			if len(body) < length - 12:
+				return
+		else:
+			hdr = fetch(4)
+			if len(hdr) < 4:
+				return
+			length = unpack(endian + "I", hdr)[0]
+
+			# the body includes the trailing copy of the block length
+			body = fetch(length - 8)
+			if len(body) < length - 8:
+				return
+
+			if block_type == BLOCK_IDB:
+				(linktype, reserved, snaplen) = unpack_from(endian + "HHI", body, 0)
+				interfaces.append((
+					linktype,
+					snaplen,
+					_tsresol(endian, body[8:len(body)-4]),
+				))
+			elif block_type == BLOCK_EPB:
+				(interface, ts_high, ts_low, cap_len, orig_len) = unpack_from(endian + "IIIII", body, 0)
+				(linktype, snaplen, scale) = interfaces[interface]
+				record = (
+					((ts_high << 32) | ts_low) * scale,
+					linktype,
+					body[20:20+cap_len],
+				)
+				if position is None:
+					yield record
+				else:
+					yield (position[0] - len(body) + 20,) + record
+			elif block_type == BLOCK_SPB:
+				# simple packets have no timestamp and are on the first interface
+				orig_len = unpack_from(endian + "I", body, 0)[0]
+				(linktype, snaplen, scale) = interfaces[0]
+				cap_len = min(orig_len, len(body) - 8)
+				if snaplen != 0:
+					cap_len = min(cap_len, snaplen)
+				if position is None:
+					yield (None, linktype, body[4:4+cap_len])
+				else:
+					yield (position[0] - len(body) + 4, None, linktype, body[4:4+cap_len])
+
+			# all other block types are skipped
+
+		hdr = fetch(4)
+		if len(hdr) < 4:
+			return
+		block_type = unpack(endian + "I", hdr)[0]
+
+# The timestamp units from the interface description options
+def _tsresol(endian, options):
+	j = 0
+	while j + 4 <= len(options):
+		(code, length) = unpack_from(endian + "HH", options, j)
+		if code == OPTION_END:
+			break
+		if code == OPTION_IF_TSRESOL and length >= 1:
+			v = options[j+4]
+			if v & 0x80:
+				return 2.0 ** -(v & 0x7F)
+			return 10.0 ** -v
+		j += 4 + ((length + 3) & ~3)
+
+	# microseconds by default
+	return 1e-6
+
+
+# Buffering for the capture writers. With a buffer size of 0 every write
+# goes straight to the file, and the caller flushes it when it wants the
+# frames to be seen, such as after each batch for a live
+# "wireshark -k -i -". Otherwise the records are collected and written
+# in one go when the buffer fills or, when poll() is called, once the
+# interval has passed since the last flush, for long captures to disk.
+class Output:
+	def __init__(self, f, buffer_size=0, interval=1.0):
+		self.f = f
+		self.buffer_size = buffer_size
+		self.interval = interval
+		self.pending = bytearray()
+		self.last_flush = time.time()
+
+	def emit(self, b):
+		if self.buffer_size == 0:
+			self.f.write(b)
+			return
+		self.pending += b
+		if len(self.pending) >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		if len(self.pending) != 0:
+			self.f.write(self.pending)
+			del self.pending[:]
+		self.f.flush()
+		self.last_flush = time.time()
+
+	# Flush if there is anything buffered and the interval has passed
+	def poll(self):
+		if len(self.pending) != 0 \
+		and time.time() - self.last_flush >= self.interval:
+			self.flush()
+
+
+# Write a classic pcap file with microsecond timestamps
+"""
+typedef struct pcap_hdr_s {
+        guint32 magic_number;   /* magic number 0xa1b2c3d4 */
+        guint16 version_major;  /* major version number */
+        guint16 version_minor;  /* minor version number */
+        gint32  thiszone;       /* GMT to local correction */
+        guint32 sigfigs;        /* accuracy of timestamps */
+        guint32 snaplen;        /* max length of captured packets, in octets */
+        guint32 network;        /* data link type LINKTYPE_IEEE802_15_4_NOFCS	230 */
+} pcap_hdr_t;
+
+typedef struct pcaprec_hdr_s {
+        guint32 ts_sec;         /* timestamp seconds */
+        guint32 ts_usec;        /* timestamp microseconds */
+        guint32 incl_len;       /* number of octets of packet saved in file */
+        guint32 orig_len;       /* actual length of packet */
+} pcaprec_hdr_t;
+"""
+class Writer(Output):
+	def __init__(self, f, linktype = LINKTYPE_IEEE802_15_4_NOFCS, snaplen = 256, buffer_size = 0, interval = 1.0):
+		Output.__init__(self, f, buffer_size, interval)
+		self.emit(pack("<IHHiIII",
+			PCAP_MAGIC,
+			2, 4,		# version 2.4
+			0,		# timezone is gmt
+			0,		# sigfigs
+			snaplen,
+			linktype,
+		))
+
+	def write(self, pkt, timestamp = None):
+		if timestamp is None:
+			timestamp = time.time()
+		seconds = int(timestamp)
+		self.emit(pack("<IIII",
+			seconds,
+			int((timestamp - seconds) * 1e6),
+			len(pkt),
+			len(pkt),
+		))
+		self.emit(pkt)
+
+
+# Write a pcapng file with a single interface and microsecond timestamps
+class NgWriter(Output):
+	def __init__(self, f, linktype = LINKTYPE_IEEE802_15_4_NOFCS, snaplen = 256, buffer_size = 0, interval = 1.0):
+		Output.__init__(self, f, buffer_size, interval)
+		self.emit(pack("<IIIHHqI",
+			BLOCK_SHB, 28,
+			BYTE_ORDER_MAGIC,
+			1, 0,		# version 1.0
+			-1,		# section length is not known
+			28,
+		))
+		self.emit(pack("<IIHHII",
+			BLOCK_IDB, 20,
+			linktype,
+			0,
+			snaplen,
+			20,
+		))
+
+	def write(self, pkt, timestamp = None):
+		if timestamp is None:
+			timestamp = time.time()
+		usec = int(timestamp * 1e6)
+		pad = -len(pkt) & 3
+		length = 32 + len(pkt) + pad
+		self.emit(pack("<IIIIIII",
+			BLOCK_EPB, length,
+			0,		# interface
+			(usec >> 32) & 0xFFFFFFFF,
+			(usec >> 0) & 0xFFFFFFFF,
+			len(pkt),
+			len(pkt),
+		))
+		self.emit(pkt)
+		self.emit(bytes(pad) + pack("<I", length))
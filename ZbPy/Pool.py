@@ -0,0 +1,87 @@
+# Free list of frame objects
+# The receive paths use these to recycle layer objects between packets
+# instead of allocating new ones, which reduces the garbage collection
+# pressure on the MicroPython heap. An object that has been put back
+# must not be used by anything else, since it will be reused.
+class Pool:
+	def __init__(self, cls, size=4, **kwargs):
+		self.cls = cls
+		self.size = size
+		self.kwargs = kwargs
+		self.free = []
+		self.allocated = 0
+		self.reused = 0
+
+	def __str__(self):
+		return "Pool(%s, free=%d/%d, allocated=%d, reused=%d)" % (
+			self.cls.__name__,
+			len(self.free),
+			self.size,
+			self.allocated,
+			self.reused,
+		)
+
+	def get(self):
+		if len(self.free) != 0:
+			self.reused += 1
+			return self.free.pop()
+		self.allocated += 1
+		return self.create()
+
+	def put(self, obj):
+		if len(self.free) >= self.size:
+			return
+		self.reset(obj)
+		self.free.append(obj)
+
+	def create(self):
+		return self.cls(**self.kwargs)
+
+	# drop the reference to the (possibly large) payload buffer
+	def reset(self, obj):
+		obj.payload = None
+
+	def lease(self):
+		return Lease(self)
+
+
+# Puts the leased object back in the pool at the end of a with block
+class Lease:
+	__slots__ = ("pool", "obj")
+
+	def __init__(self, pool):
+		self.pool = pool
+		self.obj = None
+
+	def __enter__(self):
+		self.obj = self.pool.get()
+		return self.obj
+
+	def __exit__(self, *args):
+		self.pool.put(self.obj)
+		self.obj = None
+
+
+# A pool that can be shared between threads, for handing out objects
+# that can only be used by one thread at a time. The lock is only held
+# while the free list is updated; new objects are created outside of it.
+class SharedPool(Pool):
+	def __init__(self, cls, size=4, **kwargs):
+		Pool.__init__(self, cls, size, **kwargs)
+		# not every MicroPython port has threads
+		from _thread import allocate_lock
+		self.lock = allocate_lock()
+
+	def get(self):
+		with self.lock:
+			if len(self.free) != 0:
+				self.reused += 1
+				return self.free.pop()
+			self.allocated += 1
+		return self.create()
+
+	def put(self, obj):
+		self.reset(obj)
+		with self.lock:
+			if len(self.free) < self.size:
+				self.free.append(obj)
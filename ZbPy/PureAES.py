@@ -0,0 +1,246 @@
+# Pure Python AES for hosts without pycryptodome or the Gecko
+# hardware accelerator.  This is a table driven implementation:
+# each round is sixteen lookups into precomputed T-tables that
+# combine SubBytes, ShiftRows and MixColumns on 32-bit words.
+# The expanded key schedules are cached per key, so creating
+# an AES object for a key that has been seen before is free.
+#
+# The 32-bit table entries are bigints on MicroPython, so this is
+# only intended for the host; the hardware has machine.Crypto.
+from struct import pack, unpack
+
+def _xtime(a):
+	a <<= 1
+	if a & 0x100:
+		a ^= 0x11b
+	return a
+
+# Build the S-boxes and the encryption/decryption T-tables using
+# log/antilog tables over GF(2^8) with the generator 3
+def _tables():
+	exp = [0] * 256
+	log = [0] * 256
+	x = 1
+	for i in range(255):
+		exp[i] = x
+		log[x] = i
+		x ^= _xtime(x)
+
+	def mul(a, b):
+		if a == 0 or b == 0:
+			return 0
+		return exp[(log[a] + log[b]) % 255]
+
+	sbox = [0] * 256
+	inv_sbox = [0] * 256
+	for i in range(256):
+		inv = exp[(255 - log[i]) % 255] if i != 0 else 0
+		s = inv
+		for j in range(4):
+			inv = ((inv << 1) | (inv >> 7)) & 0xFF
+			s ^= inv
+		s ^= 0x63
+		sbox[i] = s
+		inv_sbox[s] = i
+
+	te = [[0] * 256 for i in range(4)]
+	td = [[0] * 256 for i in range(4)]
+	for i in range(256):
+		s = sbox[i]
+		w = mul(s, 2) << 24 | s << 16 | s << 8 | mul(s, 3)
+		s = inv_sbox[i]
+		v = mul(s, 14) << 24 | mul(s, 9) << 16 | mul(s, 13) << 8 | mul(s, 11)
+		for t in range(4):
+			te[t][i] = w
+			td[t][i] = v
+			w = (w >> 8) | ((w & 0xFF) << 24)
+			v = (v >> 8) | ((v & 0xFF) << 24)
+
+	return sbox, inv_sbox, te, td
+
+SBOX, INV_SBOX, (TE0, TE1, TE2, TE3), (TD0, TD1, TD2, TD3) = _tables()
+
+# Expanded key schedules, indexed by the key bytes
+schedules = {}
+
+# Returns the encryption and decryption round keys as lists of 32-bit
+# words. The decryption keys are for the equivalent inverse cipher,
+# with InvMixColumns already applied to the middle rounds.
+def schedule(key):
+	key = bytes(key)
+	if key in schedules:
+		return schedules[key]
+
+	nk = len(key) // 4
+	if len(key) not in (16, 24, 32):
+		raise ValueError("AES key must be 16, 24 or 32 bytes")
+	rounds = nk + 6
+
+	ek = list(unpack(">%dI" % (nk), key))
+	rcon = 1
+	for i in range(nk, 4 * (rounds + 1)):
+		t = ek[i-1]
+		if i % nk == 0:
+			t = (SBOX[(t >> 16) & 0xFF] << 24) \
+			  | (SBOX[(t >> 8) & 0xFF] << 16) \
+			  | (SBOX[(t >> 0) & 0xFF] << 8) \
+			  | (SBOX[(t >> 24) & 0xFF] << 0)
+			t ^= rcon << 24
+			rcon = _xtime(rcon)
+		elif nk > 6 and i % nk == 4:
+			t = (SBOX[(t >> 24) & 0xFF] << 24) \
+			  | (SBOX[(t >> 16) & 0xFF] << 16) \
+			  | (SBOX[(t >> 8) & 0xFF] << 8) \
+			  | (SBOX[(t >> 0) & 0xFF] << 0)
+		ek.append(ek[i-nk] ^ t)
+
+	dk = []
+	for r in range(rounds, -1, -1):
+		for w in ek[4*r:4*r+4]:
+			if r != 0 and r != rounds:
+				w = TD0[SBOX[(w >> 24) & 0xFF]] \
+				  ^ TD1[SBOX[(w >> 16) & 0xFF]] \
+				  ^ TD2[SBOX[(w >> 8) & 0xFF]] \
+				  ^ TD3[SBOX[(w >> 0) & 0xFF]]
+			dk.append(w)
+
+	schedules[key] = (ek, dk)
+	return schedules[key]
+
+def encrypt_block(ek, b):
+	(s0, s1, s2, s3) = unpack(">4I", b)
+	s0 ^= ek[0]
+	s1 ^= ek[1]
+	s2 ^= ek[2]
+	s3 ^= ek[3]
+
+	for k in range(4, len(ek) - 4, 4):
+		t0 = TE0[s0 >> 24] ^ TE1[(s1 >> 16) & 0xFF] ^ TE2[(s2 >> 8) & 0xFF] ^ TE3[s3 & 0xFF] ^ ek[k+0]
+		t1 = TE0[s1 >> 24] ^ TE1[(s2 >> 16) & 0xFF] ^ TE2[(s3 >> 8) & 0xFF] ^ TE3[s0 & 0xFF] ^ ek[k+1]
+		t2 = TE0[s2 >> 24] ^ TE1[(s3 >> 16) & 0xFF] ^ TE2[(s0 >> 8) & 0xFF] ^ TE3[s1 & 0xFF] ^ ek[k+2]
+		t3 = TE0[s3 >> 24] ^ TE1[(s0 >> 16) & 0xFF] ^ TE2[(s1 >> 8) & 0xFF] ^ TE3[s2 & 0xFF] ^ ek[k+3]
+		s0 = t0
+		s1 = t1
+		s2 = t2
+		s3 = t3
+
+	# the last round has no MixColumns
+	k = len(ek) - 4
+	S = SBOX
+	return pack(">4I",
+		(S[s0 >> 24] << 24 | S[(s1 >> 16) & 0xFF] << 16 | S[(s2 >> 8) & 0xFF] << 8 | S[s3 & 0xFF]) ^ ek[k+0],
+		(S[s1 >> 24] << 24 | S[(s2 >> 16) & 0xFF] << 16 | S[(s3 >> 8) & 0xFF] << 8 | S[s0 & 0xFF]) ^ ek[k+1],
+		(S[s2 >> 24] << 24 | S[(s3 >> 16) & 0xFF] << 16 | S[(s0 >> 8) & 0xFF] << 8 | S[s1 & 0xFF]) ^ ek[k+2],
+		(S[s3 >> 24] << 24 | S[(s0 >> 16) & 0xFF] << 16 | S[(s1 >> 8) & 0xFF] << 8 | S[s2 & 0xFF]) ^ ek[k+3],
+	)
+
+def decrypt_block(dk, b):
+	(s0, s1, s2, s3) = unpack(">4I", b)
+	s0 ^= dk[0]
+	s1 ^= dk[1]
+	s2 ^= dk[2]
+	s3 ^= dk[3]
+
+	for k in range(4, len(dk) - 4, 4):
+		t0 = TD0[s0 >> 24] ^ TD1[(s3 >> 16) & 0xFF] ^ TD2[(s2 >> 8) & 0xFF] ^ TD3[s1 & 0xFF] ^ dk[k+0]
+		t1 = TD0[s1 >> 24] ^ TD1[(s0 >> 16) & 0xFF] ^ TD2[(s3 >> 8) & 0xFF] ^ TD3[s2 & 0xFF] ^ dk[k+1]
+		t2 = TD0[s2 >> 24] ^ TD1[(s1 >> 16) & 0xFF] ^ TD2[(s0 >> 8) & 0xFF] ^ TD3[s3 & 0xFF] ^ dk[k+2]
+		t3 = TD0[s3 >> 24] ^ TD1[(s2 >> 16) & 0xFF] ^ TD2[(s1 >> 8) & 0xFF] ^ TD3[s0 & 0xFF] ^ dk[k+3]
+		s0 = t0
+		s1 = t1
+		s2 = t2
+		s3 = t3
+
+	k = len(dk) - 4
+	S = INV_SBOX
+	return pack(">4I",
+		(S[s0 >> 24] << 24 | S[(s3 >> 16) & 0xFF] << 16 | S[(s2 >> 8) & 0xFF] << 8 | S[s1 & 0xFF]) ^ dk[k+0],
+		(S[s1 >> 24] << 24 | S[(s0 >> 16) & 0xFF] << 16 | S[(s3 >> 8) & 0xFF] << 8 | S[s2 & 0xFF]) ^ dk[k+1],
+		(S[s2 >> 24] << 24 | S[(s1 >> 16) & 0xFF] << 16 | S[(s0 >> 8) & 0xFF] << 8 | S[s3 & 0xFF]) ^ dk[k+2],
+		(S[s3 >> 24] << 24 | S[(s2 >> 16) & 0xFF] << 16 | S[(s1 >> 8) & 0xFF] << 8 | S[s0 & 0xFF]) ^ dk[k+3],
+	)
+
+
+# ECB mode AES with the same interface as the other AES wrappers,
+# plus the native counter and CBC-MAC modes used by CCM so that the
+# per-byte XOR loops in the generic CCM code are avoided.
+class AES:
+	def __init__(self, key_encrypt):
+		(self.ek, self.dk) = schedule(key_encrypt)
+
+	# There is no state between calls, so threads can share a context
+	def copy(self):
+		return self
+
+	def encrypt(self, plaintext):
+		return bytearray(self.encrypt_blocks(plaintext))
+
+	def decrypt(self, ciphertext):
+		b = bytes(ciphertext)
+		return bytearray(b''.join([
+			decrypt_block(self.dk, b[i:i+16])
+			for i in range(0, len(b), 16)
+		]))
+
+	def encrypt_blocks(self, plaintext):
+		b = bytes(plaintext)
+		return b''.join([
+			encrypt_block(self.ek, b[i:i+16])
+			for i in range(0, len(b), 16)
+		])
+
+	# Counter mode XOR of data, starting at the 16-byte counter
+	# block, which has a 16-bit counter in the last two bytes.
+	def ctr(self, counter, data):
+		n = len(data)
+		prefix = bytes(counter[0:14])
+		start = counter[14] << 8 | counter[15]
+		xor = b''.join([
+			encrypt_block(self.ek, prefix + pack(">H", (start + i) & 0xFFFF))
+			for i in range((n + 15) // 16)
+		])
+		return (int.from_bytes(data, "big") ^ int.from_bytes(xor[0:n], "big")).to_bytes(n, "big")
+
+	# The last block of the CBC encryption of data with a zero IV
+	def cbc_mac(self, data):
+		data = bytes(data)
+		x = 0
+		for i in range(0, len(data), 16):
+			x ^= int.from_bytes(data[i:i+16], "big")
+			x = int.from_bytes(encrypt_block(self.ek, x.to_bytes(16, "big")), "big")
+		return x.to_bytes(16, "big")
+
+
+# Compare the blocks/sec of this implementation with the
+# pycryptodome wrapper, if it is installed.
+# Run with "python3 -m ZbPy.PureAES"
+def benchmark(blocks=20000):
+	import time
+	key = bytes(range(16))
+	data = bytes(16 * blocks)
+
+	impls = [("pure", AES(key))]
+	try:
+		from Crypto.Cipher import AES as PyAES
+		impls.append(("pycryptodome", PyAES.new(key, PyAES.MODE_ECB)))
+	except:
+		print("pycryptodome not available")
+
+	for (name, aes) in impls:
+		# one block at a time, as the CCM ECB path uses it
+		start = time.time()
+		for i in range(0, len(data), 16):
+			aes.encrypt(data[i:i+16])
+		single = blocks / (time.time() - start)
+
+		start = time.time()
+		if name == "pure":
+			aes.encrypt_blocks(data)
+		else:
+			aes.encrypt(data)
+		bulk = blocks / (time.time() - start)
+
+		print("%-14s %10.0f blocks/sec single %10.0f blocks/sec bulk" % (name, single, bulk))
+
+if __name__ == "__main__":
+	benchmark()
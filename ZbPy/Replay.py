@@ -0,0 +1,115 @@
+# Duplicate and replay filter for received frames.
+#
+# Each source has a sliding window over its last few MAC sequence numbers,
+# NWK sequence numbers and NWK security frame counters: the highest value
+# seen and a bitmap of which of the values below it have also been seen,
+# so repeats that arrive out of order are caught as well as back to back
+# retransmits. The sources are kept in LRU caches of a fixed size, one for
+# each kind of counter, so idle sources are evicted and a large mesh can
+# not grow the filter without bound.
+#
+# The 8-bit sequence numbers wrap, so a value more than a window behind
+# is taken to be a restarted source rather than a dupe. The frame counters
+# never wrap, and any value behind the window is a replay.
+from ZbPy import Cache
+
+MAC_SEQ = 0
+NWK_SEQ = 1
+FRAME_COUNTER = 2
+
+# The frame counter does not wrap
+moduli = (0x100, 0x100, 0)
+
+class Replay:
+	# The window has to fit in a MicroPython small int, which is 31 bits
+	def __init__(self, size=64, window=16):
+		if window > 30:
+			raise ValueError("Window too large")
+		self.window = window
+		self.mask = (1 << window) - 1
+		self.sources = [Cache.LRU(size) for m in moduli]
+		self.dupes = 0
+		self.replays = 0
+
+	def __str__(self):
+		return "Replay(window=%d, dupes=%d, replays=%d, mac=%s, nwk=%s, counter=%s)" % (
+			self.window,
+			self.dupes,
+			self.replays,
+			self.sources[MAC_SEQ],
+			self.sources[NWK_SEQ],
+			self.sources[FRAME_COUNTER],
+		)
+
+	def clear(self):
+		for lru in self.sources:
+			lru.clear()
+
+	# Record a value from a source, returning True if it has already been
+	# seen or is too old to be accepted
+	def seen(self, kind, src, value):
+		lru = self.sources[kind]
+		entry = lru.get(src)
+		if entry is None:
+			lru.put(src, [value, 1])
+			return False
+
+		highest = entry[0]
+		modulus = moduli[kind]
+		d = value - highest
+		if modulus != 0:
+			# the nearest distance, in either direction
+			d %= modulus
+			if d >= modulus >> 1:
+				d -= modulus
+
+		if d > 0:
+			# newer than all of the others, slide the window forward
+			entry[0] = value
+			if d >= self.window:
+				entry[1] = 1
+			else:
+				entry[1] = ((entry[1] << d) | 1) & self.mask
+			return False
+
+		d = -d
+		if d >= self.window:
+			if modulus == 0:
+				self.replays += 1
+				return True
+			entry[0] = value
+			entry[1] = 1
+			return False
+
+		bit = 1 << d
+		if entry[1] & bit:
+			self.dupes += 1
+			return True
+		entry[1] |= bit
+		return False
+
+	# Check an IEEE802154 frame; only short source addresses are tracked
+	def ieee(self, ieee):
+		if type(ieee.src) is not int:
+			return False
+		return self.seen(MAC_SEQ, ieee.src, ieee.seq)
+
+	# Check a deserialized ZigbeeNetwork frame. Nothing is recorded for
+	# secured frames that did not decrypt correctly, since anyone can send
+	# a frame with a sequence number or frame counter ahead of the real
+	# ones. Relays re-secure the frames that they forward, so the counters
+	# are tracked by the source in the security header, not the NWK source.
+	def nwk(self, nwk):
+		if nwk.security and not nwk.valid:
+			return False
+		dupe = self.seen(NWK_SEQ, nwk.src, nwk.seq)
+		if nwk.security and nwk.ext_src is not None:
+			c = nwk.sec_seq
+			counter = 0 \
+				| c[3] << 24 \
+				| c[2] << 16 \
+				| c[1] << 8 \
+				| c[0] << 0
+			if self.seen(FRAME_COUNTER, bytes(nwk.ext_src), counter):
+				dupe = True
+		return dupe
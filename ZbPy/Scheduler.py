@@ -0,0 +1,166 @@
+# Timer scheduler for the device loops.
+#
+# Components register timers with a deadline instead of checking their
+# timeouts on every pass through the loop, and the loop blocks until the
+# radio has a frame or the next deadline arrives. The timers are kept in a
+# hashed timer wheel: a ring of slots, each a tick of resolution usec wide,
+# with a timer in the slot for its deadline modulo the size of the ring,
+# so starting and firing a timer does not depend on how many others there
+# are. Timers further out than one turn of the wheel wait in their slot
+# until the wheel comes around to their tick.
+#
+# Time is kept as microseconds since the scheduler was created, so the
+# deadlines do not wrap along with MicroPython's ticks_us().
+try:
+	from time import ticks_us, ticks_diff
+except:
+	import time
+	def ticks_us():
+		return int(time.time() * 1e6)
+	def ticks_diff(a, b):
+		return a - b
+
+class Timer:
+	__slots__ = (
+		"func",
+		"period",
+		"when",
+		"tick",
+		"active",
+	)
+
+	# func is called when the timer fires; a timer with a period
+	# is started again for one period after its last deadline
+	def __init__(self, func, period=0):
+		self.func = func
+		self.period = period
+		self.when = 0
+		self.tick = 0
+		self.active = False
+
+
+class Scheduler:
+	def __init__(self, resolution=1000, slots=256):
+		self.resolution = resolution
+		self.slots = [[] for i in range(slots)]
+		self.current = 0
+		self.count = 0
+		self.last = ticks_us()
+		self.elapsed = 0
+		self.fired = 0
+
+	def __str__(self):
+		return "Scheduler(resolution=%d, slots=%d, timers=%d, fired=%d)" % (
+			self.resolution,
+			len(self.slots),
+			self.count,
+			self.fired,
+		)
+
+	# Microseconds since the scheduler was created
+	def now(self):
+		t = ticks_us()
+		self.elapsed += ticks_diff(t, self.last)
+		self.last = t
+		return self.elapsed
+
+	# Start (or restart) a timer to fire in delay usec
+	def start(self, timer, delay):
+		self.start_at(timer, self.now() + delay)
+
+	def start_at(self, timer, when):
+		if timer.active:
+			self.cancel(timer)
+		tick = when // self.resolution
+		if tick < self.current:
+			tick = self.current
+		timer.when = when
+		timer.tick = tick
+		timer.active = True
+		self.slots[tick % len(self.slots)].append(timer)
+		self.count += 1
+
+	def cancel(self, timer):
+		if not timer.active:
+			return
+		timer.active = False
+		self.slots[timer.tick % len(self.slots)].remove(timer)
+		self.count -= 1
+
+	# New timers to call func once after delay usec, or every period usec
+	def after(self, delay, func):
+		timer = Timer(func)
+		self.start(timer, delay)
+		return timer
+
+	def every(self, period, func):
+		timer = Timer(func, period)
+		self.start(timer, period)
+		return timer
+
+	# Microseconds until the next timer is due, 0 if one is overdue,
+	# or None if there are no timers
+	def timeout(self):
+		if self.count == 0:
+			return None
+		slots = self.slots
+		size = len(slots)
+		when = None
+		for k in range(size):
+			tick = self.current + k
+			for timer in slots[tick % size]:
+				if timer.tick == tick \
+				and (when is None or timer.when < when):
+					when = timer.when
+			if when is not None:
+				break
+		if when is None:
+			# everything is more than a turn of the wheel away
+			for slot in slots:
+				for timer in slot:
+					if when is None or timer.when < when:
+						when = timer.when
+		when -= self.now()
+		if when < 0:
+			return 0
+		return when
+
+	# Fire the timers that are due, in the order of their deadlines.
+	# Returns the number that fired.
+	def run(self):
+		now = self.now()
+		target = now // self.resolution
+		slots = self.slots
+		size = len(slots)
+		steps = target - self.current + 1
+		if steps > size:
+			steps = size
+
+		due = []
+		for k in range(steps):
+			for timer in slots[(self.current + k) % size]:
+				if timer.when <= now:
+					due.append(timer)
+
+		# the target tick may still have timers later in it
+		self.current = target
+		if len(due) == 0:
+			return 0
+
+		# the callbacks may cancel or restart the other due timers
+		due.sort(key=lambda timer: timer.when)
+		fired = 0
+		for timer in due:
+			if not timer.active or timer.when > now:
+				continue
+			self.cancel(timer)
+			if timer.period != 0:
+				when = timer.when + timer.period
+				if when <= now:
+					# fell behind; do not fire the missed periods
+					when = now + timer.period
+				self.start_at(timer, when)
+			timer.func()
+			fired += 1
+		self.fired += fired
+		return fired
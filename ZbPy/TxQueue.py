@@ -0,0 +1,162 @@
+# Transmit queue for an IEEE 802.15.4 device.
+#
+# Frames are serialized into preallocated buffers and queued by priority,
+# so MAC commands go out ahead of bulk data. Several ack-requested frames
+# can be outstanding at once; they are keyed by their MAC sequence number,
+# since that is all an ACK carries, and each one has its own retry count
+# and retransmit timer in the device's scheduler (see Scheduler.py).
+# When a frame is acked, runs out of retries or is sent without asking
+# for an ack, its done function is called with whether it was delivered
+# and its buffer is reused.
+from ZbPy import Packet
+from ZbPy import Scheduler
+
+PRIO_CMD = 0
+PRIO_DATA = 1
+PRIORITIES = 2
+
+class Frame:
+	__slots__ = (
+		"buf",
+		"view",
+		"length",
+		"seq",
+		"ack_req",
+		"retries",
+		"timer",
+		"done",
+	)
+
+	def __init__(self, expire):
+		self.buf = bytearray(Packet.MAX_FRAME)
+		self.view = memoryview(self.buf)
+		self.length = 0
+		self.seq = 0
+		self.ack_req = False
+		self.retries = 0
+		self.timer = Scheduler.Timer(lambda: expire(self))
+		self.done = None
+
+	def data(self):
+		return self.view[0:self.length]
+
+
+class TxQueue:
+	# size frames can be queued or outstanding, with at most
+	# window of them waiting for their ACK at the same time
+	def __init__(self, radio, sched, size=8, window=4, retries=3, timeout=1000000, fail=None):
+		self.radio = radio
+		self.sched = sched
+		self.window = window
+		self.retries = retries
+		self.timeout = timeout
+		self.fail = fail
+		self.free = [Frame(self.expire) for i in range(size)]
+		self.queued = [[] for i in range(PRIORITIES)]
+		self.pending = {}
+
+		self.sent = 0
+		self.acked = 0
+		self.failed = 0
+		self.retransmits = 0
+		self.dropped = 0
+
+	def __str__(self):
+		return "TxQueue(queued=%d, pending=%d, sent=%d, acked=%d, failed=%d, retransmits=%d, dropped=%d)" % (
+			len(self.queued[PRIO_CMD]) + len(self.queued[PRIO_DATA]),
+			len(self.pending),
+			self.sent,
+			self.acked,
+			self.failed,
+			self.retransmits,
+			self.dropped,
+		)
+
+	# A free frame to serialize into, or None if the queue is full
+	def get(self):
+		if len(self.free) == 0:
+			self.dropped += 1
+			return None
+		return self.free.pop()
+
+	# Return a frame from get() that was not queued
+	def release(self, frame):
+		frame.done = None
+		self.free.append(frame)
+
+	# Queue a frame that has been serialized into a buffer from get()
+	def put(self, frame, seq, prio=PRIO_DATA, ack_req=False, done=None):
+		frame.seq = seq
+		frame.ack_req = ack_req
+		frame.retries = self.retries
+		frame.done = done
+		self.queued[prio].append(frame)
+
+	# Returns True if there are frames waiting to be sent or acked
+	def busy(self):
+		if len(self.pending) != 0:
+			return True
+		for q in self.queued:
+			if len(q) != 0:
+				return True
+		return False
+
+	# An ACK has arrived; returns False if nothing was waiting for it
+	def ack(self, seq):
+		frame = self.pending.pop(seq, None)
+		if frame is None:
+			return False
+		self.sched.cancel(frame.timer)
+		self.acked += 1
+		self.complete(frame, True)
+		# the window has room for another frame
+		self.send()
+		return True
+
+	def complete(self, frame, ok):
+		done = frame.done
+		frame.done = None
+		self.free.append(frame)
+		if not ok:
+			self.failed += 1
+			if self.fail is not None:
+				self.fail(frame.seq)
+		if done is not None:
+			done(ok)
+
+	# Send queued frames, highest priority first, while the window has room
+	def send(self):
+		for q in self.queued:
+			while len(q) != 0:
+				frame = q[0]
+				if frame.ack_req:
+					if len(self.pending) >= self.window:
+						return
+					if frame.seq in self.pending:
+						# the sequence number has wrapped onto
+						# a frame that is still outstanding
+						return
+				q.pop(0)
+				self.transmit(frame)
+
+	def transmit(self, frame):
+		self.sent += 1
+		self.radio.tx(frame.data())
+		if not frame.ack_req:
+			self.complete(frame, True)
+			return
+		self.pending[frame.seq] = frame
+		self.sched.start(frame.timer, self.timeout)
+
+	# The ACK for a frame is overdue; retransmit it or give up on it
+	def expire(self, frame):
+		if frame.retries == 0:
+			del self.pending[frame.seq]
+			self.complete(frame, False)
+			self.send()
+			return
+		print("RETX %02x %d" % (frame.seq, frame.retries))
+		frame.retries -= 1
+		self.retransmits += 1
+		self.sched.start(frame.timer, self.timeout)
+		self.radio.tx(frame.data())
@@ -6,6 +6,7 @@
 #   ZigbeeClusterLibrary (ZCL)
 # ->ZCL ClusterParser
 import struct
+from ZbPy import Packet
 
 clusters = {
 0x0000: {
@@ -82,9 +83,27 @@ def pack(fmt, names, data):
 	for name in names:
 		l.append(data[name])
 	return struct.pack(fmt, *l)
+
+# Pack the named values directly into buf at offset,
+# returning the offset of the end of them
+def pack_into(fmt, names, data, buf, offset):
+	l = []
+	for name in names:
+		l.append(data[name])
+	end = offset + struct.calcsize(fmt)
+	Packet.check_room(buf, end)
+	struct.pack_into(fmt, buf, offset, *l)
+	return end
 	
 
 class ZCL:
+	__slots__ = (
+		"cluster",
+		"command",
+		"name",
+		"payload",
+	)
+
 	def __init__(self,
 		data = None,
 		cluster = None,
@@ -120,6 +139,11 @@ class ZCL:
 		fmt = clusters[cluster_id][command_id]
 		return pack(fmt[1], fmt[2], self.payload)
 
+	def serialize_into(self, buf, offset):
+		cluster_id, command_id = lookup(self.name)
+		fmt = clusters[cluster_id][command_id]
+		return pack_into(fmt[1], fmt[2], self.payload, buf, offset)
+
 #print(ZCL(cluster=0x08, command=0x06, data=b'\x00+\x05\x00'))
 #x = ZCL(name='LevelControl.StepOnOff', payload={'dir': 0, 'step': 43, 'time': 5})
 #print(x.serialize())
@@ -4,6 +4,7 @@
 #   (Optional encryption, with either Trust Center Key or Transport Key)
 #-> ZigbeeApplicationSupport (APS)
 #   ZigbeeClusterLibrary (ZCL)
+from ZbPy import Packet
 
 MODE_UNICAST = 0x0
 MODE_BROADCAST = 0x2
@@ -24,6 +25,19 @@ CLUSTER_DEVICE_ENDPOINT_DESCR_RESPONSE	= 0x8004
 CLUSTER_DEVICE_ANNOUNCEMENT		= 0x0013
 
 class ZigbeeApplication:
+	__slots__ = (
+		"frame_type",
+		"mode",
+		"security",
+		"ack_req",
+		"src",
+		"dst",
+		"cluster",
+		"profile",
+		"seq",
+		"payload",
+	)
+
 
 	# parse the ZigBee Application packet
 	# src/dst are endpoints
@@ -105,29 +119,37 @@ class ZigbeeApplication:
 		return self
 
 	def serialize(self):
-		hdr = bytearray()
+		return Packet.serialize(self)
+
+	# Write the header and payload into buf at offset,
+	# returning the offset of the end of the frame
+	def serialize_into(self, buf, offset):
 		fcf = 0 \
 			| (self.frame_type << 0) \
 			| (self.mode << 2) \
 			| (self.ack_req << 6)
 
-		hdr.append(fcf)
 		if self.mode == MODE_GROUP:
-			hdr.append((self.dst >> 0) & 0xFF)
-			hdr.append((self.dst >> 8) & 0xFF)
+			Packet.check_room(buf, offset + 9)
 		else:
-			hdr.append(self.dst & 0xFF)
+			Packet.check_room(buf, offset + 8)
 
-		hdr.append((self.cluster >> 0) & 0xFF)
-		hdr.append((self.cluster >> 8) & 0xFF)
-		hdr.append((self.profile >> 0) & 0xFF)
-		hdr.append((self.profile >> 8) & 0xFF)
-		hdr.append(self.src)
-		hdr.append(self.seq & 0x7F)
-
-		if type(self.payload) is bytes or type(self.payload) is bytearray:
-			hdr.extend(self.payload)
+		j = offset
+		buf[j] = fcf ; j += 1
+		if self.mode == MODE_GROUP:
+			buf[j+0] = (self.dst >> 0) & 0xFF
+			buf[j+1] = (self.dst >> 8) & 0xFF
+			j += 2
 		else:
-			hdr.extend(self.payload.serialize())
+			buf[j] = self.dst & 0xFF
+			j += 1
+
+		buf[j+0] = (self.cluster >> 0) & 0xFF
+		buf[j+1] = (self.cluster >> 8) & 0xFF
+		buf[j+2] = (self.profile >> 0) & 0xFF
+		buf[j+3] = (self.profile >> 8) & 0xFF
+		buf[j+4] = self.src
+		buf[j+5] = self.seq & 0x7F
+		j += 6
 
-		return hdr
+		return Packet.serialize_payload(self.payload, buf, j)
@@ -10,12 +10,23 @@
 # something about groups of nodes, but is Zigbee-speak for groups of commands.
 # The commands are split into different groups for things like On/Off, Level control,
 # OTA updates, etc.
+from ZbPy import Packet
 
 FRAME_TYPE_CLUSTER_SPECIFIC = 1
 DIRECTION_TO_SERVER = 0
 DIRECTION_TO_CLIENT = 1
 
 class ZigbeeCluster:
+	__slots__ = (
+		"frame_type",
+		"direction",
+		"manufacturer_specific",
+		"disable_default_response",
+		"seq",
+		"command",
+		"payload",
+	)
+
 
 	def __init__(self,
 		data = None,
@@ -75,20 +86,20 @@ class ZigbeeCluster:
 		return self
 
 	def serialize(self):
-		hdr = bytearray()
+		return Packet.serialize(self)
+
+	# Write the header and payload into buf at offset,
+	# returning the offset of the end of the frame
+	def serialize_into(self, buf, offset):
 		fcf = 0 \
 			| (self.frame_type << 0) \
 			| (self.manufacturer_specific << 2) \
 			| (self.direction << 3) \
 			| (self.disable_default_response << 4)
 
-		hdr.append(fcf)
-		hdr.append(self.seq & 0x7F)
-		hdr.append(self.command)
-
-		if type(self.payload) is bytes or type(self.payload) is bytearray:
-			hdr.extend(self.payload)
-		else:
-			hdr.extend(self.payload.serialize())
+		Packet.check_room(buf, offset + 3)
+		buf[offset+0] = fcf
+		buf[offset+1] = self.seq & 0x7F
+		buf[offset+2] = self.command
 
-		return hdr
+		return Packet.serialize_payload(self.payload, buf, offset + 3)
@@ -30,8 +30,86 @@ CMD_NETWORK_UPDATE	= 0x0a
 DEST_BROADCAST		= 0xFFFD
 
 from ZbPy import CCM
+from ZbPy import KeyRing
+from ZbPy import Packet
+from ZbPy.Packet import unpacker
+
+# dst, src, radius and seq follow the frame control field
+header = unpacker("<HHBB")
+
+# The decoded frame control field flags and the offsets of
+# the optional extended addresses for one FCF value
+class Decoder:
+	__slots__ = (
+		"frame_type",
+		"version",
+		"discover_route",
+		"multicast",
+		"security",
+		"source_route",
+		"ext_dst",
+		"ext_src",
+		"length",
+	)
+
+	def __init__(self, fcf):
+		self.frame_type		= (fcf >> 0) & 3
+		self.version		= (fcf >> 2) & 15
+		self.discover_route	= (fcf >> 6) & 3
+		self.multicast		= (fcf >> 8) & 1
+		self.security		= (fcf >> 9) & 1
+		self.source_route	= (fcf >> 10) & 1
+		dst_mode		= (fcf >> 11) & 1
+		src_mode		= (fcf >> 12) & 1
+
+		j = 8
+		self.ext_dst = None
+		self.ext_src = None
+
+		# extended dest is present
+		if dst_mode:
+			self.ext_dst = j
+			j += 8
+
+		# extended source is present
+		if src_mode:
+			self.ext_src = j
+			j += 8
+
+		self.length = j
+
+# Indexed by the frame control field, since only a few are ever used
+decoders = {}
+
+def decoder(fcf):
+	if fcf not in decoders:
+		decoders[fcf] = Decoder(fcf)
+	return decoders[fcf]
 
 class ZigbeeNetwork:
+	__slots__ = (
+		"aes",
+		"validate",
+		"ccm",
+		"frame_type",
+		"version",
+		"discover_route",
+		"multicast",
+		"source_route",
+		"src",
+		"dst",
+		"radius",
+		"seq",
+		"ext_src",
+		"ext_dst",
+		"payload",
+		"security",
+		"sec_seq",
+		"sec_key",
+		"sec_key_seq",
+		"valid",
+	)
+
 
 	# parse the ZigBee network layer
 	def __init__(self,
@@ -57,6 +135,7 @@ class ZigbeeNetwork:
 	):
 		self.aes = aes
 		self.validate = validate
+		self.ccm = None # pending decryption
 
 		if data is not None:
 			self.deserialize(data)
@@ -120,36 +199,32 @@ class ZigbeeNetwork:
 
 		return "ZigbeeNetwork(" + ", ".join(params) + ")"
 
-	# Create an object from bytes on a wire
-	def deserialize(self, b):
-		j = 0
-		fcf = (b[j+1] << 8) | (b[j+0] << 0); j += 2
-		self.frame_type		= (fcf >> 0) & 3
-		self.version		= (fcf >> 2) & 15
-		self.discover_route	= (fcf >> 6) & 3
-		self.multicast		= (fcf >> 8) & 1
-		self.security		= (fcf >> 9) & 1
-		self.source_route	= (fcf >> 10) & 1
-		dst_mode		= (fcf >> 11) & 1
-		src_mode		= (fcf >> 12) & 1
-
-		self.dst = (b[j+1] << 8) | (b[j+0] << 0); j += 2
-		self.src = (b[j+1] << 8) | (b[j+0] << 0); j += 2
-		self.radius = b[j]; j += 1
-		self.seq = b[j]; j += 1
+	# Create an object from bytes on a wire. If decrypt is False then
+	# the CCM* work is deferred until decrypt() is called; the payload
+	# is the ciphertext and valid is None until then.
+	# If b is a memoryview of a bytearray, the fields and payload are
+	# views into it and the payload is decrypted in place.
+	def deserialize(self, b, decrypt=True):
+		d = decoder((b[1] << 8) | (b[0] << 0))
+		self.frame_type		= d.frame_type
+		self.version		= d.version
+		self.discover_route	= d.discover_route
+		self.multicast		= d.multicast
+		self.security		= d.security
+		self.source_route	= d.source_route
+
+		(self.dst, self.src, self.radius, self.seq) = header(b, 2)
 
 		self.ext_dst = None
 		self.ext_src = None
+		self.ccm = None
 
-		# extended dest is present
-		if dst_mode:
-			self.ext_dst = b[j:j+8]
-			j += 8
+		if d.ext_dst is not None:
+			self.ext_dst = b[d.ext_dst:d.ext_dst+8]
+		if d.ext_src is not None:
+			self.ext_src = b[d.ext_src:d.ext_src+8]
 
-		# extended source is present
-		if src_mode:
-			self.ext_src = b[j:j+8]
-			j += 8
+		j = d.length
 
 		if not self.security:
 			# the rest of the packet is the payload
@@ -159,17 +234,24 @@ class ZigbeeNetwork:
 			# security header is present, attempt to decrypt
 			# and validate the message.
 			try:
-				self.ccm_decrypt(b, j)
-				self.valid = True
+				self.ccm_prepare(b, j)
+				if decrypt:
+					self.decrypt()
 			except:
 				print("---- BAD CCM ----")
+				self.ccm = None
 				self.valid = False
 				self.payload = b[j:]
 		return self
 
 	# Convert an object back to bytes, with optional encryption
 	def serialize(self):
-		hdr = bytearray()
+		return Packet.serialize(self)
+
+	# Write the header and payload into buf at offset, encrypting
+	# the payload in place if security is enabled, and return the
+	# offset of the end of the frame.
+	def serialize_into(self, buf, offset):
 		fcf = 0 \
 			| (self.frame_type << 0) \
 			| (self.version << 2) \
@@ -177,40 +259,48 @@ class ZigbeeNetwork:
 			| (self.multicast << 8) \
 			| (self.security << 9) \
 			| (self.source_route << 10)
-		hdr.append(0) # FCF will be filled in later
-		hdr.append(0)
-		hdr.append((self.dst >> 0) & 0xFF)
-		hdr.append((self.dst >> 8) & 0xFF)
-		hdr.append((self.src >> 0) & 0xFF)
-		hdr.append((self.src >> 8) & 0xFF)
-		hdr.append(self.radius)
-		hdr.append(self.seq & 0x7F)
+		# the header has to fit before any of it is written
+		end = offset + 8
 		if self.ext_dst is not None:
-			hdr.extend(self.ext_dst)
+			end += 8
+		if self.ext_src is not None:
+			end += 8
+		Packet.check_room(buf, end)
+
+		buf[offset+2] = (self.dst >> 0) & 0xFF
+		buf[offset+3] = (self.dst >> 8) & 0xFF
+		buf[offset+4] = (self.src >> 0) & 0xFF
+		buf[offset+5] = (self.src >> 8) & 0xFF
+		buf[offset+6] = self.radius
+		buf[offset+7] = self.seq & 0x7F
+		j = offset + 8
+		if self.ext_dst is not None:
+			buf[j:j+8] = self.ext_dst
+			j += 8
 			fcf |= 1 << 11
 		if self.ext_src is not None:
-			hdr.extend(self.ext_src)
+			buf[j:j+8] = self.ext_src
+			j += 8
 			fcf |= 1 << 12
 
-		if type(self.payload) is bytes or type(self.payload) is bytearray:
-			payload = self.payload
-		else:
-			payload = self.payload.serialize()
-
 		# fill in the updated field control field
-		hdr[0] = (fcf >> 0) & 0xFF
-		hdr[1] = (fcf >> 8) & 0xFF
+		buf[offset+0] = (fcf >> 0) & 0xFF
+		buf[offset+1] = (fcf >> 8) & 0xFF
 
 		if not self.security:
-			hdr.extend(payload)
-			return hdr
+			return Packet.serialize_payload(self.payload, buf, j)
 		else:
-			fcf |= 1 << 9
-			return self.ccm_encrypt(hdr, payload)
+			return self.ccm_encrypt(buf, offset, j)
 
 	# security header is present; b contains the entire Zigbee NWk header
 	# so that the entire MIC can be computed
 	def ccm_decrypt(self, b, j):
+		self.ccm_prepare(b, j)
+		return self.decrypt()
+
+	# Parse the security header and setup the pending decryption
+	# of the payload, without doing any of the AES work.
+	def ccm_prepare(self, b, j):
 		# the security control field is not filled in correctly in the header,
 		# so it is necessary to patch it up to contain ZBEE_SEC_ENC_MIC32
 		# == 5. Not sure why, but wireshark does it.
@@ -247,29 +337,83 @@ class ZigbeeNetwork:
 
 		# authenticated data is everything up to the message
 		# which includes the network header and the unmodified sec_hdr value
+		if len(b) < j + 4:
+			raise ValueError("NWK frame too short for MIC")
 		auth = b[0:j]
 		C = b[j:-4]  # cipher text
 		M = b[-4:]   # message integrity code
 
-		if not CCM.decrypt(auth, C, M, nonce, self.aes, validate=self.validate):
-			print("BAD DECRYPT: ", bytes(b))
-			#print("message=", C)
-			self.payload = C
-			self.valid = False
-		else:
-			self.payload = C
-			self.valid = True
-
-	# Re-encrypt a message and return the security header plus encrypted payload and MIC
-	def ccm_encrypt(self, hdr, payload):
+		self.payload = C
+		self.valid = None
+		self.ccm = (b, auth, C, M, nonce)
+
+	# Finish a decryption deferred by deserialize(decrypt=False),
+	# trying each of the candidate keys if there is a key ring
+	def decrypt(self):
+		if self.ccm is None:
+			return self.valid
+
+		(b, auth, C, M, nonce) = self.ccm
+		keys = self.keys()
+		if len(keys) > 1:
+			# keep a copy, since the decryption is done in place
+			orig = bytes(C) + bytes(M)
+
+		valid = False
+		for i in range(len(keys)):
+			if i != 0:
+				C[:] = orig[0:len(C)]
+				M[:] = orig[len(C):]
+			valid = CCM.decrypt(auth, C, M, bytearray(nonce), keys[i], validate=self.validate)
+			if valid:
+				self.validated(keys[i])
+				break
+
+		if not valid and len(keys) > 1:
+			# leave the payload as decrypted by the most likely key
+			C[:] = orig[0:len(C)]
+			CCM.decrypt(auth, C, M, bytearray(nonce), keys[0], validate=False)
+
+		self.decrypted(valid)
+		return self.valid
+
+	# The AES contexts that might decrypt this message
+	def keys(self):
+		if type(self.aes) is KeyRing.KeyRing:
+			return self.aes.candidates(self.ext_src, self.sec_key, self.sec_key_seq)
+		return [self.aes]
+
+	# Tell the key ring which key worked for this source
+	def validated(self, aes):
+		if type(self.aes) is KeyRing.KeyRing:
+			self.aes.validated(self.ext_src, aes)
+
+	# Record the result of the pending decryption, which
+	# has been done in place on the payload
+	def decrypted(self, valid):
+		if not valid:
+			print("BAD DECRYPT: ", bytes(self.ccm[0]))
+			#print("message=", self.payload)
+		self.ccm = None
+		self.valid = valid
+
+	# Add the security header at j in buf, after the NWK header at offset,
+	# followed by the payload, which is encrypted in place, and the MIC.
+	# Returns the offset of the end of the frame.
+	def ccm_encrypt(self, buf, offset, j):
 		sec_hdr = (0x05 << 0) \
 			| (self.sec_key << 3) \
 			| (1 << 5)
-		sec_hdr_offset = len(hdr) # for updates later
-		hdr.append(sec_hdr)
-		hdr.extend(self.sec_seq)
-		hdr.extend(self.ext_src) # should be only if we have a ext_src, but it has better be there
-		hdr.append(self.sec_key_seq)
+		sec_hdr_offset = j # for updates later
+		Packet.check_room(buf, j + 14)
+		buf[j] = sec_hdr
+		buf[j+1:j+5] = self.sec_seq
+		buf[j+5:j+13] = self.ext_src # should be only if we have a ext_src, but it has better be there
+		buf[j+13] = self.sec_key_seq
+		j += 14
+
+		end = Packet.serialize_payload(self.payload, buf, j)
+		Packet.check_room(buf, end + 4)
 
 		nonce = bytearray(16)
 		nonce[0] = 0x01
@@ -279,13 +423,63 @@ class ZigbeeNetwork:
 		nonce[14] = 0x00
 		nonce[15] = 0x00
 
-		mic = CCM.encrypt(hdr, payload, nonce, self.aes)
+		aes = self.aes
+		if type(aes) is KeyRing.KeyRing:
+			aes = aes.key(self.sec_key, self.sec_key_seq)
 
 		# payload is encrypted in place
-		hdr.extend(payload)
-		hdr.extend(mic)
+		view = memoryview(buf)
+		mic = CCM.encrypt(view[offset:j], view[j:end], nonce, aes)
+		buf[end:end+4] = mic
 
 		# for WTF reasons, they don't send the MIC parameters in the header.
-		hdr[sec_hdr_offset] = sec_hdr & ~7
-
-		return hdr
+		buf[sec_hdr_offset] = sec_hdr & ~7
+
+		return end + 4
+
+
+# Decode a list of NWK frames, batching the CCM* work for all of
+# the secured frames into a single call. With a key ring, the frames
+# are grouped by their most likely key and any that fail to validate
+# are retried with the other candidate keys.
+def deserialize_many(datas, aes, validate=True):
+	pkts = []
+	groups = {}
+	for b in datas:
+		nwk = ZigbeeNetwork(aes=aes, validate=validate)
+		nwk.deserialize(b, decrypt=False)
+		pkts.append(nwk)
+		if nwk.ccm is None:
+			continue
+
+		keys = nwk.keys()
+		if len(keys) == 0:
+			nwk.decrypted(False)
+		elif keys[0] in groups:
+			groups[keys[0]].append(nwk)
+		else:
+			groups[keys[0]] = [nwk]
+
+	ring = type(aes) is KeyRing.KeyRing and len(aes) > 1
+	for key, pending in groups.items():
+		if ring:
+			origs = [bytes(nwk.ccm[2]) + bytes(nwk.ccm[3]) for nwk in pending]
+
+		frames = [nwk.ccm[1:] for nwk in pending]
+		valids = CCM.decrypt_many(frames, key, validate=validate)
+
+		for i in range(len(pending)):
+			nwk = pending[i]
+			if valids[i]:
+				nwk.validated(key)
+				nwk.decrypted(True)
+			elif ring:
+				# restore the ciphertext and try all of the keys
+				(b, auth, C, M, nonce) = nwk.ccm
+				C[:] = origs[i][0:len(C)]
+				M[:] = origs[i][len(C):]
+				nwk.decrypt()
+			else:
+				nwk.decrypted(False)
+
+	return pkts